@@ -1,6 +1,12 @@
 __author__ = 'Progressive Company'
 __version__ = (0, 1, 1)
 
-from mongoengine_relational.relationalmixin import RelationManagerMixin, RelationalError, ReferenceField, GenericReferenceField, ListField
+from mongoengine_relational.relationalmixin import RelationManagerMixin, RelationalError, VersionConflictError, ReferenceField, GenericReferenceField, ListField
 
-from mongoengine_relational.cache import DocumentCache
+from mongoengine_relational.cache import DocumentCache, ThreadSafeDocumentCache
+from mongoengine_relational.proxy import DocumentProxy
+from mongoengine_relational.queryset import RelationalQuerySet
+from mongoengine_relational.batch import WriteBatch
+from mongoengine_relational.outbox import ChangeFeed
+from mongoengine_relational.invalidation import InvalidationBus, MemoryBus, UnixSocketBus, MulticastBus
+from mongoengine_relational.scope import CacheScope, get_current_scope
@@ -0,0 +1,284 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+
+class _RecordingCollection( object ):
+    '''
+    Stands in for a document's collection while it's written through a `WriteBatch`. Writes are recorded
+    on the batch (and acknowledged right away), reads go straight to the collection. Follow-ups that should
+    only happen once the writes are stored (see `RelationManagerMixin._after_write`) are deferred until the
+    batch has executed.
+    '''
+    def __init__( self, batch, collection ):
+        self._batch = batch
+        self._collection = collection
+
+    def __getattr__( self, name ):
+        return getattr( self._collection, name )
+
+    @property
+    def database( self ):
+        return _RecordingDatabase( self._batch, self._collection.database )
+
+    def insert( self, doc, *args, **kwargs ):
+        # Like pymongo, assign an id to new documents before sending them
+        doc.setdefault( '_id', ObjectId() )
+        self._batch._record( self._collection, 'insert', None, doc )
+        return doc[ '_id' ]
+
+    def append( self, doc ):
+        '''
+        Record an insert of `doc` without assigning it an id; it gets one when the batch executes.
+        '''
+        self._batch._record( self._collection, 'insert', None, doc )
+
+    def save( self, doc, *args, **kwargs ):
+        if '_id' not in doc:
+            return self.insert( doc )
+
+        self._batch._record( self._collection, 'replace', { '_id': doc[ '_id' ] }, doc, upsert=True )
+        return doc[ '_id' ]
+
+    def update( self, spec, document, upsert=False, multi=False, retry=None, **kwargs ):
+        self._batch._record( self._collection, 'update', spec, document, upsert=upsert, multi=multi, retry=retry )
+        return { 'ok': 1, 'n': 1, 'updatedExisting': True }
+
+    def remove( self, spec_or_id=None, multi=True, **kwargs ):
+        spec = spec_or_id if isinstance( spec_or_id, dict ) else { '_id': spec_or_id } if spec_or_id is not None else {}
+        self._batch._record( self._collection, 'remove', spec, None, multi=multi )
+        return { 'ok': 1, 'n': 1 }
+
+    def defer( self, function, *args ):
+        self._batch._callbacks.append( ( function, args ) )
+
+
+class _RecordingDatabase( object ):
+    '''
+    Hands out recording collections, so writes to other collections (like the outbox) join the batch.
+    '''
+    def __init__( self, batch, database ):
+        self._batch = batch
+        self._database = database
+
+    def __getattr__( self, name ):
+        return getattr( self._database, name )
+
+    def __getitem__( self, name ):
+        return _RecordingCollection( self._batch, self._database[ name ] )
+
+
+class WriteBatch( object ):
+    '''
+    Collects the writes of several `save`, `update` and `delete` calls, and sends them to the database
+    together when it's executed:
+
+        with WriteBatch() as batch:
+            batch.save( animal, request )
+            batch.save( new_zoo, request )
+            batch.save( old_zoo, request )
+
+    The writes run in a single transaction where the client and server support it. Otherwise (like on
+    standalone servers, or before pymongo 3.6), consecutive writes to the same collection are sent as one
+    ordered bulk operation.
+
+    Hooks and relation maintenance happen right away; reads and writes for delete rules and edge collections
+    aren't batched. Sharing saved documents with other caches and publishing invalidations is deferred
+    until the batch has executed successfully.
+
+    Writes aren't checked against the database when they're recorded. Conditional updates (like versioned
+    writes) are sent on their own instead, so it's known whether they matched. One that didn't has been
+    overtaken by another write; it's retried after merging the stored document (see
+    `RelationManagerMixin._retry_versioned`), or raises a `VersionConflictError` that rolls back the
+    transaction (if any). Updates without a condition that don't match are ignored, like outside a batch.
+
+    When executing fails, or the batch is left with an exception, the change tracking (memos, changed fields
+    and version) of the documents written through the batch is restored, so they can be saved again. Changes
+    made to related documents in memory (like the relations cleared by `delete`) aren't undone.
+    '''
+    def __init__( self, transaction=True, write_concern=None ):
+        '''
+        @param transaction: whether to use a transaction where possible
+        @type transaction: bool
+        @param write_concern: the write concern for bulk operations
+        @type write_concern: dict
+        '''
+        self.transaction = transaction
+        self.write_concern = write_concern
+        self._operations = []
+        self._callbacks = []
+        self._states = []
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if exc_type is None:
+            self.execute()
+        else:
+            self._reset( restore=True )
+
+    def __len__( self ):
+        return len( self._operations )
+
+    def save( self, doc, *args, **kwargs ):
+        '''
+        Call `doc.save`, recording its writes on this batch.
+        '''
+        return self.call( doc, doc.save, *args, **kwargs )
+
+    def update( self, doc, *args, **kwargs ):
+        '''
+        Call `doc.update`, recording its writes on this batch.
+        '''
+        return self.call( doc, doc.update, *args, **kwargs )
+
+    def delete( self, doc, *args, **kwargs ):
+        '''
+        Call `doc.delete`, recording its writes on this batch.
+        '''
+        return self.call( doc, doc.delete, *args, **kwargs )
+
+    def call( self, doc, method, *args, **kwargs ):
+        '''
+        Call `method`, recording the writes it makes to `doc`'s collection on this batch.
+
+        @type doc: Document
+        @type method: callable
+        '''
+        if hasattr( doc, '_get_write_state' ):
+            self._states.append( ( doc, doc._get_write_state() ) )
+
+        doc._get_collection = lambda collection=_RecordingCollection( self, doc._get_collection() ): collection
+
+        try:
+            return method( *args, **kwargs )
+        finally:
+            del doc._get_collection
+
+    def execute( self ):
+        '''
+        Send all recorded writes to the database, and run the follow-ups that were waiting for them.
+        '''
+        operations, callbacks = self._operations, self._callbacks
+
+        try:
+            self._execute( operations )
+        except Exception:
+            self._reset( restore=True )
+            raise
+
+        self._reset()
+
+        for function, args in callbacks:
+            function( *args )
+
+    def _reset( self, restore=False ):
+        '''
+        Forget the recorded writes and follow-ups. With `restore`, the documents written through this batch
+        get their state from before they were written back.
+        '''
+        if restore:
+            # Restore in reverse, so a document written more than once ends up with its earliest state
+            for doc, state in reversed( self._states ):
+                doc._set_write_state( state )
+
+        self._operations = []
+        self._callbacks = []
+        self._states = []
+
+    def _execute( self, operations ):
+        # Split the operations into runs on the same collection, keeping their order. Conditional updates get
+        # a run of their own, so we know whether they matched a document.
+        runs = []
+        for collection, operation in operations:
+            is_conditional = operation[ 5 ] is not None
+
+            if runs and runs[ -1 ][ 0 ] == collection and not is_conditional and not runs[ -1 ][ 2 ]:
+                runs[ -1 ][ 1 ].append( operation )
+            else:
+                runs.append( ( collection, [ operation ], is_conditional ) )
+
+        if not runs:
+            return
+
+        # Check the class; pymongo 2 databases turn any attribute into a collection
+        client = getattr( runs[ 0 ][ 0 ].database, 'client', None )
+
+        if self.transaction and callable( getattr( type( client ), 'start_session', None ) ):
+            try:
+                with client.start_session() as session:
+                    with session.start_transaction():
+                        for collection, run, is_conditional in runs:
+                            self._execute_run( collection, run, is_conditional, session )
+                return
+            except OperationFailure as e:
+                # Transactions aren't supported by standalone servers; nothing has been written
+                if e.code != 20:
+                    raise
+
+        for collection, run, is_conditional in runs:
+            self._execute_run( collection, run, is_conditional )
+
+    def _record( self, collection, kind, spec, document, upsert=False, multi=False, retry=None ):
+        self._operations.append( ( collection, ( kind, spec, document, upsert, multi, retry ) ) )
+
+    def _execute_run( self, collection, run, is_conditional=False, session=None ):
+        if callable( getattr( type( collection ), 'bulk_write', None ) ):
+            from pymongo import InsertOne, ReplaceOne, UpdateOne, UpdateMany, DeleteMany, DeleteOne
+
+            requests = []
+            for kind, spec, document, upsert, multi, retry in run:
+                if kind == 'insert':
+                    requests.append( InsertOne( document ) )
+                elif kind == 'replace':
+                    requests.append( ReplaceOne( spec, document, upsert=upsert ) )
+                elif kind == 'update':
+                    requests.append( ( UpdateMany if multi else UpdateOne )( spec, document, upsert=upsert ) )
+                else:
+                    requests.append( ( DeleteMany if multi else DeleteOne )( spec ) )
+
+            kwargs = { 'session': session } if session is not None else {}
+
+            if self.write_concern is not None:
+                from pymongo import WriteConcern
+                collection = collection.with_options( write_concern=WriteConcern( **self.write_concern ) )
+
+            result = collection.bulk_write( requests, ordered=True, **kwargs )
+            if not result.acknowledged:
+                return
+
+            matched = result.matched_count
+        else:
+            bulk = collection.initialize_ordered_bulk_op()
+
+            for kind, spec, document, upsert, multi, retry in run:
+                if kind == 'insert':
+                    bulk.insert( document )
+                    continue
+
+                operation = bulk.find( spec ).upsert() if upsert else bulk.find( spec )
+                if kind == 'replace':
+                    operation.replace_one( document )
+                elif kind == 'update' and multi:
+                    operation.update( document )
+                elif kind == 'update':
+                    operation.update_one( document )
+                elif multi:
+                    operation.remove()
+                else:
+                    operation.remove_one()
+
+            # Unacknowledged writes don't return results
+            result = bulk.execute( self.write_concern )
+            if not result:
+                return
+
+            matched = result[ 'nMatched' ]
+
+        # A conditional update that didn't match has been overtaken by another write since it was recorded
+        if is_conditional and not matched:
+            kind, spec, document, upsert, multi, retry = run[ 0 ]
+            retry( collection, spec, document, session )
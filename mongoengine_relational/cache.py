@@ -2,14 +2,88 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import collections
+import mmap
+import os
+import struct
+import threading
+import time
+import weakref
 
 from mongoengine import Document
+from mongoengine.base import get_document
 from mongoengine.queryset import QuerySet
-from bson import DBRef, ObjectId
+from bson import BSON, DBRef, ObjectId, SON
+
+from .executor import run_parallel
+from .proxy import DocumentProxy
+
+
+DEFAULT_CACHE_POLICY = { 'scope': 'request', 'ttl': None, 'max_entries': None, 'version_field': None }
+
+
+def get_cache_policy( document_type ):
+    '''
+    Get the caching policy for `document_type`, as declared in its `meta` under `relational_cache`:
+
+        * `scope`: 'request' (the default) to cache documents for the lifetime of a `DocumentCache`,
+          'process' to share them between caches as well, or 'none' to not cache them at all
+        * `ttl`: the number of seconds a document stays cached
+        * `max_entries`: the maximum number of documents of this class to cache; the oldest are evicted first
+        * `version_field`: the field that changes whenever a document is saved, used to validate snapshots.
+          Defaults to the class's `meta['version_field']`, or an `updated_at` or `version` field if it has one.
+
+    @type document_type: type
+    @rtype: dict
+    '''
+    policy = dict( DEFAULT_CACHE_POLICY, **getattr( document_type, '_meta', {} ).get( 'relational_cache', {} ) )
+
+    if policy[ 'scope' ] not in ( 'request', 'process', 'none' ):
+        raise ValueError( 'Invalid `relational_cache` scope `{}` for `{}`'.format( policy[ 'scope' ], document_type.__name__ ) )
+
+    if not policy[ 'version_field' ]:
+        fields = getattr( document_type, '_fields', {} )
+        policy[ 'version_field' ] = getattr( document_type, '_meta', {} ).get( 'version_field' ) or \
+            next( ( name for name in ( 'updated_at', 'version' ) if name in fields ), None )
+
+    return policy
 
 
 class DocumentCache( object ):
-    def __init__( self, request=None ):
+    '''
+    Holds the documents loaded during a request, keyed by id.
+
+    References found to be dangling are remembered as well (a tombstone per collection and id), so they aren't
+    queried again for the lifetime of the cache, or for `missing_ttl` seconds if given. Define `on_missing` on a
+    subclass (or set it on an instance) to be notified of each dangling reference; it's called with the
+    document class and the missing id.
+
+    With `weak=True`, clean documents are only held weakly, so they can be garbage collected once application
+    code is done with them. Documents with pending changes are held strongly until they're saved.
+
+    How documents of a class are cached can be configured in its `meta`; see `get_cache_policy`. Documents of
+    classes with 'process' scope are shared between caches in serialized form, and rehydrated for each cache.
+    To keep shared documents in sync between processes, connect an `InvalidationBus` using `use_bus`.
+
+    Cached documents can be written to a snapshot file with `dump_snapshot`, and read back by `load_snapshot`
+    to warm up a new process. Snapshotted documents are decoded when they're first fetched, after checking their
+    `version_field` against the database; `get` only returns documents that are cached already.
+    '''
+    # Documents shared by all caches, per Document class: an OrderedDict of id to ( son, expires ) tuples
+    _shared = {}
+    _shared_lock = threading.RLock()
+
+    # The `InvalidationBus` that changes to shared documents are published on
+    bus = None
+
+    # When invalidations were received, by collection and id; remembered for `invalidation_window` seconds
+    _invalidated = collections.OrderedDict()
+    invalidation_window = 60
+
+    # Documents available from a snapshot, by id: ( buffer, offset, length ) tuples pointing at encoded records
+    _snapshot = {}
+    _snapshot_files = []
+
+    def __init__( self, request=None, missing_ttl=None, weak=False ):
         if request:
             if not hasattr( request, 'cache' ):
                 request.cache = self
@@ -17,7 +91,15 @@ class DocumentCache( object ):
                 raise RuntimeError( 'A `DocumentCache` already exists; only one should be created per request.' )
 
         self.request = request
-        self._documents = {}
+        self.weak = weak
+        self._documents = weakref.WeakValueDictionary() if weak else {}
+        self._retained = {}
+        self._proxies = {}
+        self._partial = {}
+        self._missing = {}
+        self._expires = {}
+        self._order = collections.defaultdict( collections.OrderedDict )
+        self.missing_ttl = missing_ttl
 
     def __iter__( self ):
         return iter( self._documents )
@@ -31,15 +113,78 @@ class DocumentCache( object ):
     def __setitem__(self, id, value):
         """Dictionary-style field access, set a field's value.
         """
-        if isinstance( value, Document ):
-            self._documents[ str( id ) ] = value
+        # Only cache actual documents; a proxy stands in for a document that may not even be loaded yet
+        if isinstance( value, DocumentProxy ):
+            value = value._document
 
-            # Set the `request` on the Document, so it can take advantage of the cache itself
-            if self.request and hasattr( value, '_set_request' ) and callable( value._set_request ):
-                value._set_request( self.request, update_relations=False )
+        if isinstance( value, Document ):
+            key = str( id )
+            if self._store( key, value ):
+                self._stored( key, value )
 
             return value
 
+    def _store( self, key, value ):
+        '''
+        Store `value` as the cache entry for `key`, unless its class isn't cached at all.
+
+        @type key: string
+        @type value: Document
+        @return: whether `value` has been stored
+        @rtype: bool
+        '''
+        policy = get_cache_policy( value.__class__ )
+        if policy[ 'scope' ] == 'none':
+            return False
+
+        # Drop state left behind by a previous (garbage collected) document for this id
+        if key not in self._documents:
+            self._partial.pop( key, None )
+
+        self._documents[ key ] = value
+        self._missing.pop( ( value._get_collection_name(), key ), None )
+
+        if self.weak and ( value._created or getattr( value, '_changed_fields', None ) ):
+            self.retain( value )
+
+        if policy[ 'ttl' ]:
+            self._expires[ key ] = time.time() + policy[ 'ttl' ]
+
+        return True
+
+    def _stored( self, key, value ):
+        '''
+        Follow up on storing `value`: evict documents if its class has `max_entries`, and attach our request.
+
+        @type key: string
+        @type value: Document
+        '''
+        policy = get_cache_policy( value.__class__ )
+        if policy[ 'max_entries' ]:
+            self._evict( value.__class__, policy[ 'max_entries' ], key )
+
+        # Set the `request` on the Document, so it can take advantage of the cache itself
+        if self.request and hasattr( value, '_set_request' ) and callable( value._set_request ):
+            value._set_request( self.request, update_relations=False )
+
+    def _insert( self, key, value ):
+        '''
+        Store `value` as the cache entry for `key`, unless there's an entry already.
+
+        @type key: string
+        @type value: Document
+        @return: the cached document for `key`; `value` if it has been inserted
+        @rtype: Document
+        '''
+        doc = self._documents.get( key )
+        if doc is not None:
+            return doc
+
+        if self._store( key, value ):
+            self._stored( key, value )
+
+        return value
+
     def __delitem__( self, id ):
         return self.remove( id )
 
@@ -54,7 +199,11 @@ class DocumentCache( object ):
         object_id = None
         doc = None
 
-        if isinstance( item, Document ):
+        if isinstance( item, DocumentProxy ):
+            # Look up the proxied document by id; never trigger a load from here
+            object_id = item.pk
+
+        elif isinstance( item, Document ):
             object_id = item.pk
 
             # If it's a new document (no pk), just return it. We can't cache it yet
@@ -72,13 +221,278 @@ class DocumentCache( object ):
             object_id = item
 
         if doc is None and object_id:
-            try:
-                doc = self._documents[ str( object_id ) ]
-            except KeyError:
-                pass
+            doc = self._lookup( str( object_id ) )
 
         return doc or default
 
+    def _lookup( self, key ):
+        '''
+        Find the document for `key`, honoring its `ttl`. Documents that are shared between caches are
+        rehydrated and added to this cache.
+
+        @type key: string
+        @rtype: Document or None
+        '''
+        doc = self._documents.get( key )
+
+        # Like evicting, expiry never drops a document with pending changes
+        if doc is not None and key in self._expires and self._expires[ key ] <= time.time() and \
+                not doc._created and not getattr( doc, '_changed_fields', None ):
+            self._remove_single_document( key )
+            doc = None
+
+        if doc is None:
+            with self._shared_lock:
+                shared = [ ( document_type, entries[ key ] ) for document_type, entries in self._shared.items() if key in entries ]
+
+            for document_type, ( son, expires ) in shared:
+                if expires is None or expires > time.time():
+                    doc = self._insert( key, document_type._from_son( son ) )
+                else:
+                    with self._shared_lock:
+                        self._shared[ document_type ].pop( key, None )
+
+        return doc
+
+    def _evict( self, document_type, max_entries, key=None ):
+        '''
+        Evict the oldest documents of `document_type` until at most `max_entries` are left.
+        Documents with pending changes are never evicted.
+
+        @param key: the key of a document of `document_type` that has just been stored
+        '''
+        keys = self._order[ document_type ]
+        if key is not None:
+            keys[ key ] = None
+
+        for key in list( keys ):
+            if len( keys ) <= max_entries:
+                break
+
+            doc = self._documents.get( key )
+            if doc is None:
+                del keys[ key ]
+            elif not doc._created and not getattr( doc, '_changed_fields', None ):
+                self._remove_single_document( key )
+                del keys[ key ]
+
+    def share( self, doc, read_at=None ):
+        '''
+        Share the current state of `doc` with all caches, if its class is cached with 'process' scope.
+        Only fully loaded, unmodified documents are shared, and only if no invalidation for `doc` has been
+        received since `read_at`; its state may be older than the change that was announced.
+
+        @type doc: Document
+        @param read_at: the time (of this process) at which `doc`'s state was read or written; not checked if omitted
+        @type read_at: float
+        '''
+        policy = get_cache_policy( doc.__class__ )
+        if policy[ 'scope' ] != 'process' or not doc.pk or doc._created or getattr( doc, '_changed_fields', None ) or self.is_partial( doc ):
+            return
+
+        key = str( doc.pk )
+        entry = ( doc.to_mongo(), time.time() + policy[ 'ttl' ] if policy[ 'ttl' ] else None )
+
+        with self._shared_lock:
+            # Invalidations are only remembered for so long; a state that's read before that can't be checked
+            if read_at is not None and ( read_at <= time.time() - self.invalidation_window or
+                    self._invalidated.get( ( doc._get_collection_name(), key ), 0 ) >= read_at ):
+                return
+
+            entries = self._shared.setdefault( doc.__class__, collections.OrderedDict() )
+            entries.pop( key, None )
+            entries[ key ] = entry
+
+            while policy[ 'max_entries' ] and len( entries ) > policy[ 'max_entries' ]:
+                entries.popitem( last=False )
+
+    def unshare( self, doc ):
+        '''
+        Stop sharing `doc` between caches.
+
+        @type doc: Document
+        '''
+        with self._shared_lock:
+            if doc.pk and doc.__class__ in self._shared:
+                self._shared[ doc.__class__ ].pop( str( doc.pk ), None )
+
+    @classmethod
+    def clear_shared( cls ):
+        '''
+        Stop sharing all documents between caches, and forget the invalidations that have been received.
+        '''
+        with cls._shared_lock:
+            cls._shared.clear()
+            cls._invalidated.clear()
+
+    def publish( self, doc ):
+        '''
+        Announce a change to `doc` on the `InvalidationBus`, if its class is shared between caches
+        (has 'process' scope), so other processes drop their copy.
+
+        @type doc: Document
+        '''
+        if self.bus is not None and doc.pk and get_cache_policy( doc.__class__ )[ 'scope' ] == 'process':
+            self.bus.publish( doc._get_collection_name(), str( doc.pk ) )
+
+    @classmethod
+    def use_bus( cls, bus ):
+        '''
+        Publish changes to shared documents on `bus`, and drop shared documents when changes to them are received.
+        Pass `None` to disconnect.
+
+        @type bus: InvalidationBus or None
+        '''
+        if cls.bus is not None:
+            cls.bus.unsubscribe( cls.invalidate )
+
+        cls.bus = bus
+
+        if bus is not None:
+            bus.subscribe( cls.invalidate )
+
+    @classmethod
+    def invalidate( cls, collection, object_id ):
+        '''
+        Drop the shared document for `object_id` in `collection`. The time the invalidation is received is
+        remembered, so a state read before it isn't shared again afterwards (see `share`).
+
+        @type collection: string
+        @type object_id: ObjectId or string
+        '''
+        now = time.time()
+
+        with cls._shared_lock:
+            for document_type, entries in cls._shared.items():
+                if document_type._get_collection_name() == collection:
+                    entries.pop( str( object_id ), None )
+
+            key = ( collection, str( object_id ) )
+            cls._invalidated.pop( key, None )
+            cls._invalidated[ key ] = now
+
+            while cls._invalidated and next( iter( cls._invalidated.values() ) ) <= now - cls.invalidation_window:
+                cls._invalidated.popitem( last=False )
+
+    def dump_snapshot( self, path ):
+        '''
+        Write the documents shared between caches, and the documents in this cache, to a snapshot file at `path`.
+        Only fully loaded, unmodified documents of classes with a `version_field` are included.
+
+        @type path: string
+        @return: the number of documents written
+        @rtype: int
+        '''
+        sons = collections.OrderedDict()
+
+        with self._shared_lock:
+            for document_type, entries in self._shared.items():
+                for key, ( son, expires ) in entries.items():
+                    if expires is None or expires > time.time():
+                        sons[ key ] = ( document_type, son )
+
+        for key, doc in self._documents.items():
+            if key not in sons and not doc._created and not getattr( doc, '_changed_fields', None ) and not self.is_partial( doc ):
+                sons[ key ] = ( doc.__class__, doc.to_mongo() )
+
+        count = 0
+        with open( path + '.tmp', 'wb' ) as snapshot:
+            for key, ( document_type, son ) in sons.items():
+                policy = get_cache_policy( document_type )
+                if policy[ 'scope' ] != 'none' and policy[ 'version_field' ]:
+                    # Put the id first, so it can be read without decoding the whole record
+                    snapshot.write( BSON.encode( SON( [ ( '_id', key ), ( 'cls', document_type._class_name ), ( 'son', son ) ] ) ) )
+                    count += 1
+
+        os.rename( path + '.tmp', path )
+        return count
+
+    @classmethod
+    def load_snapshot( cls, path ):
+        '''
+        Make the documents in the snapshot file at `path` available to all caches. The file is memory-mapped,
+        and only its index is read up front.
+
+        @type path: string
+        @return: the number of documents available
+        @rtype: int
+        '''
+        with open( path, 'rb' ) as snapshot:
+            if not os.fstat( snapshot.fileno() ).st_size:
+                return 0
+
+            data = mmap.mmap( snapshot.fileno(), 0, access=mmap.ACCESS_READ )
+
+        cls._snapshot_files.append( data )
+        count = 0
+        offset = 0
+        while offset < len( data ):
+            # Each record is a BSON document, starting with its length and the `_id` string element:
+            # int32 length, type byte, '_id\x00', int32 string length (including the trailing null), string
+            length, = struct.unpack_from( '<i', data, offset )
+            id_length, = struct.unpack_from( '<i', data, offset + 9 )
+            key = data[ offset + 13:offset + 12 + id_length ].decode( 'utf-8' )
+
+            cls._snapshot[ key ] = ( data, offset, length )
+            offset += length
+            count += 1
+
+        return count
+
+    @classmethod
+    def clear_snapshot( cls ):
+        '''
+        Forget the documents from snapshots that haven't been used yet, and close the snapshot files.
+        '''
+        cls._snapshot.clear()
+
+        while cls._snapshot_files:
+            cls._snapshot_files.pop().close()
+
+    def _load_snapshot_entries( self, document_type, keys ):
+        '''
+        Decode the snapshotted documents of `document_type` for `keys`, and add those that are still up to date
+        to this cache. Their versions are checked against the database in a single query.
+
+        @type document_type: type
+        @type keys: list<string>
+        @return: the documents that have been added, by key
+        @rtype: dict
+        '''
+        collection_name = document_type._get_collection_name()
+        records = {}
+
+        for key in keys:
+            entry = self._snapshot.pop( key, None )
+            if entry is None:
+                continue
+
+            data, offset, length = entry
+            record = BSON( data[ offset:offset + length ] ).decode()
+            if get_document( record[ 'cls' ] )._get_collection_name() == collection_name:
+                records[ key ] = record
+            else:
+                # Not a document of this collection; leave it for whoever asks for that one
+                self._snapshot[ key ] = entry
+
+        if not records:
+            return {}
+
+        db_field = document_type._fields[ get_cache_policy( document_type )[ 'version_field' ] ].db_field
+        read_at = time.time()
+        current = document_type._get_collection().find(
+            { '_id': { '$in': [ record[ 'son' ][ '_id' ] for record in records.values() ] } }, { db_field: 1 } )
+        versions = dict( ( str( son[ '_id' ] ), son.get( db_field ) ) for son in current )
+
+        docs = {}
+        for key, record in records.items():
+            son = record[ 'son' ]
+            if key in versions and versions[ key ] == son.get( db_field ):
+                docs[ key ] = self._insert( key, get_document( record[ 'cls' ] )._from_son( son ) )
+                self.share( docs[ key ], read_at )
+
+        return docs
+
     def add( self, documents ):
         '''
         Add one or more documents to the cache. Only Documents will be returned.
@@ -89,14 +503,23 @@ class DocumentCache( object ):
         '''
         docs = None
 
-        if isinstance( documents, Document ):
+        if isinstance( documents, DocumentProxy ):
+            docs = self._add_proxy( documents )
+
+        elif isinstance( documents, Document ):
             # Set the `request` on the Document, so it can take advantage of the cache itself
             docs = self._add_single_document( documents )
 
         elif isinstance( documents, ( QuerySet, collections.Iterable ) ):
+            # Let a `RelationalQuerySet` use this cache, so documents that are already known aren't built again
+            if isinstance( documents, QuerySet ) and hasattr( documents, 'with_cache' ) and documents._document_cache is None:
+                documents = documents.with_cache( self )
+
             docs = []
             for obj in documents:
-                if isinstance( obj, Document ):
+                if isinstance( obj, DocumentProxy ):
+                    docs.append( self._add_proxy( obj ) )
+                elif isinstance( obj, Document ):
                     obj = self._add_single_document( obj )
                     docs.append( obj )
 
@@ -117,13 +540,294 @@ class DocumentCache( object ):
         # If it does have a `pk`, set it as the cache entry for this document if there's no entry yet,
         # or return the cache entry.
         if doc.pk:
-            if doc in self:
-                doc = self._documents[ str( doc.pk ) ]
-            else:
-                self[ doc.pk ] = doc
+            doc = self._insert( str( doc.pk ), doc )
 
         return doc
 
+    def _add_proxy( self, proxy ):
+        '''
+        Add the document behind a `DocumentProxy` to the cache if it has been loaded. Unloaded proxies are
+        returned as-is; adding them to the cache shouldn't cause a fetch.
+
+        @type proxy: DocumentProxy
+        '''
+        if proxy.is_loaded():
+            return self._add_single_document( proxy._document )
+
+        return self.get( proxy, proxy )
+
+    def proxy( self, dbref, document_type ):
+        '''
+        Get a `DocumentProxy` for `dbref`. The proxy is registered as pending, so it will be
+        loaded together with all other pending proxies for `document_type` on first access.
+        Returns the cached document instead if it's already present.
+
+        @type dbref: DBRef
+        @type document_type: type
+        @rtype: DocumentProxy or Document
+        '''
+        doc = self.get( dbref )
+        if doc is not None:
+            return doc
+
+        return self._get_proxy( str( dbref.id ), dbref, document_type )
+
+    def _get_proxy( self, key, dbref, document_type ):
+        '''
+        Get the pending proxy for `key`, creating it if there isn't one yet.
+
+        @type key: string
+        @rtype: DocumentProxy
+        '''
+        proxy = self._proxies.get( key )
+        if proxy is None:
+            proxy = self._proxies[ key ] = DocumentProxy( dbref, document_type, self )
+
+        return proxy
+
+    def load_proxies( self, document_type ):
+        '''
+        Fetch the documents for all pending proxies of `document_type` in a single query,
+        and add them to the cache.
+
+        @type document_type: type
+        @return: the list of fetched documents
+        @rtype: Document[]
+        '''
+        pending = [ proxy for proxy in self._proxies.values() if proxy._document_type is document_type ]
+        docs = self.fetch( document_type, [ proxy.to_dbref() for proxy in pending ] )
+
+        for proxy in pending:
+            doc = self._documents.get( str( proxy.pk ) )
+            if doc is not None:
+                proxy._document = doc
+                self._proxies.pop( str( proxy.pk ), None )
+
+        return docs
+
+    def fetch( self, document_type, items, only=None ):
+        '''
+        Get the documents for `items` from the cache, querying the database (in a single `$in` query)
+        only for those that aren't present yet. When `only` is given, the query is limited to those fields,
+        and the documents are marked as partially loaded. Cached documents that lack any of the requested
+        fields (all fields, if `only` isn't given) are upgraded first.
+
+        @param items: references to documents of `document_type`
+        @type items: DBRef[] or Document[] or ObjectId[]
+        @param only: the names of the fields to load
+        @type only: list<string> or set<string>
+        @return: the list of documents that could be found, in the order of `items`
+        @rtype: Document[]
+        '''
+        return self.fetch_many( [ ( document_type, items, only ) ] )[ 0 ]
+
+    def fetch_many( self, requests, parallel=False ):
+        '''
+        `fetch` the documents for several `( document_type, items, only )` requests. With `parallel`, the database
+        queries for the requests run at the same time; only the queries do, as the results are added to the cache
+        on the calling thread. So any cache can be used.
+
+        @type requests: list
+        @type parallel: bool
+        @return: the documents for each request, as returned by `fetch`
+        @rtype: list
+        '''
+        fetches = [ self._prepare_fetch( *request ) for request in requests ]
+
+        # Queries that can run without touching the cache; others run when their results are added
+        queries = [ fetch for fetch in fetches if fetch[ 'missing_ids' ] and hasattr( fetch[ 'queryset' ], '_find_bulk' ) ]
+        calls = [ ( fetch[ 'queryset' ]._find_bulk, ( fetch[ 'missing_ids' ], ) ) for fetch in queries ]
+        results = run_parallel( calls ) if parallel else [ function( *args ) for function, args in calls ]
+
+        for fetch, sons in zip( queries, results ):
+            fetch[ 'sons' ] = sons
+
+        return [ self._complete_fetch( fetch ) for fetch in fetches ]
+
+    def _prepare_fetch( self, document_type, items, only=None ):
+        '''
+        Determine which documents for `items` are cached, and set up the query for the others.
+
+        @return: the state of the fetch, for `_complete_fetch`
+        @rtype: dict
+        '''
+        # Keep track of the requested ids, or the documents themselves if they haven't been saved yet
+        entries = []
+        for item in items:
+            if isinstance( item, DocumentProxy ):
+                item = item.to_dbref()
+            elif isinstance( item, Document ):
+                # Documents are simply added to (or replaced by their duplicate in) the cache
+                item = self.get( item )
+                if not item.pk:
+                    entries.append( item )
+                    continue
+
+            object_id = item.pk if isinstance( item, Document ) else item.id if isinstance( item, DBRef ) else item
+            if object_id:
+                entries.append( object_id )
+
+        object_ids = [ entry for entry in entries if not isinstance( entry, Document ) ]
+
+        loaded = dict( ( str( object_id ), self._lookup( str( object_id ) ) ) for object_id in object_ids )
+
+        # Use snapshotted documents that are still up to date
+        snapshotted = [ key for key, doc in loaded.items() if doc is None and key in self._snapshot ]
+        if snapshotted:
+            loaded.update( self._load_snapshot_entries( document_type, snapshotted ) )
+
+        missing_ids = [ object_id for object_id in object_ids
+                            if loaded[ str( object_id ) ] is None and not self.is_missing( document_type, object_id ) ]
+
+        fetch = { 'document_type': document_type, 'only': only, 'entries': entries, 'loaded': loaded,
+            'missing_ids': missing_ids, 'partial_docs': [ doc for doc in loaded.values() if doc is not None and self.is_partial( doc, only ) ],
+            'read_at': time.time(), 'queryset': None, 'sons': None }
+
+        if missing_ids:
+            queryset = document_type.objects.only( *only ) if only else document_type.objects
+
+            # Load into this cache, rather than the one of the active `CacheScope`
+            if hasattr( queryset, 'with_cache' ):
+                queryset = queryset.with_cache( self )
+                queryset._read_at = fetch[ 'read_at' ]
+
+            fetch[ 'queryset' ] = queryset
+
+        return fetch
+
+    def _complete_fetch( self, fetch ):
+        '''
+        Add the documents found by a fetch (see `_prepare_fetch`) to the cache.
+
+        @type fetch: dict
+        @rtype: Document[]
+        '''
+        document_type, only, loaded, missing_ids = fetch[ 'document_type' ], fetch[ 'only' ], fetch[ 'loaded' ], fetch[ 'missing_ids' ]
+
+        if missing_ids:
+            queryset = fetch[ 'queryset' ]
+            found = queryset._load_bulk( fetch[ 'sons' ] ) if fetch[ 'sons' ] is not None else queryset.in_bulk( missing_ids )
+
+            for doc in self.add( found.values() ):
+                loaded[ str( doc.pk ) ] = doc
+                if only:
+                    self._partial[ str( doc.pk ) ] = frozenset( only )
+                else:
+                    self.share( doc, fetch[ 'read_at' ] )
+
+            found_ids = set( str( object_id ) for object_id in found )
+            for object_id in missing_ids:
+                if str( object_id ) not in found_ids:
+                    self.add_missing( document_type, object_id )
+
+        if fetch[ 'partial_docs' ]:
+            self.upgrade( fetch[ 'partial_docs' ] )
+
+        docs = [ entry if isinstance( entry, Document ) else loaded.get( str( entry ) ) for entry in fetch[ 'entries' ] ]
+        return [ doc for doc in docs if doc is not None ]
+
+    def retain( self, doc ):
+        '''
+        Hold `doc` strongly (in weak mode), since it has pending changes.
+
+        @type doc: Document
+        '''
+        if self.weak and doc.pk and str( doc.pk ) in self._documents:
+            self._retained[ str( doc.pk ) ] = doc
+
+    def release( self, doc ):
+        '''
+        Let go of the strong reference to `doc` (in weak mode), once its changes have been saved.
+
+        @type doc: Document
+        '''
+        if doc.pk:
+            self._retained.pop( str( doc.pk ), None )
+
+    def add_missing( self, document_type, item ):
+        '''
+        Record that the document for `item` doesn't exist in the collection for `document_type`,
+        and report it through `on_missing`.
+
+        @type document_type: type
+        @type item: DBRef or ObjectId or string
+        '''
+        object_id = item.id if isinstance( item, DBRef ) else item
+        expires = time.time() + self.missing_ttl if self.missing_ttl is not None else None
+        self._missing[ ( document_type._get_collection_name(), str( object_id ) ) ] = expires
+
+        if hasattr( self, 'on_missing' ) and callable( self.on_missing ):
+            self.on_missing( document_type, object_id )
+
+    def is_missing( self, document_type, item ):
+        '''
+        Determine whether the document for `item` is known not to exist in the collection for `document_type`.
+
+        @type document_type: type
+        @type item: DBRef or ObjectId or string
+        @rtype: bool
+        '''
+        object_id = item.id if isinstance( item, DBRef ) else item
+        key = ( document_type._get_collection_name(), str( object_id ) )
+
+        if key not in self._missing:
+            return False
+
+        expires = self._missing[ key ]
+        if expires is not None and expires <= time.time():
+            del self._missing[ key ]
+            return False
+
+        return True
+
+    def is_partial( self, item, only=None ):
+        '''
+        Determine whether the cached document for `item` has been loaded partially. If `only` is given,
+        the document only counts as partial if it's missing any of those fields.
+
+        @type item: Document or DBRef or ObjectId or string
+        @type only: list<string> or set<string>
+        @rtype: bool
+        '''
+        object_id = item.pk if isinstance( item, Document ) else item.id if isinstance( item, DBRef ) else item
+        loaded_fields = self._partial.get( str( object_id ) )
+
+        if loaded_fields is None:
+            return False
+
+        return not only or not loaded_fields.issuperset( only )
+
+    def upgrade( self, documents ):
+        '''
+        Fully load partially loaded documents, in place. Fields that weren't loaded before are filled in
+        from a single query per document class, so any references to these documents stay valid.
+
+        @type documents: Document[]
+        '''
+        docs_by_class = collections.defaultdict( dict )
+        for doc in documents:
+            if self.is_partial( doc ):
+                docs_by_class[ doc.__class__ ][ doc.pk ] = doc
+
+        for document_type, docs in docs_by_class.items():
+            for son in document_type._get_collection().find( { '_id': { '$in': docs.keys() } } ):
+                doc = docs[ son[ '_id' ] ]
+                loaded_fields = self._partial[ str( doc.pk ) ]
+                missing_fields = [ name for name in doc._fields if name not in loaded_fields ]
+
+                for name in missing_fields:
+                    field = doc._fields[ name ]
+                    if field.db_field in son:
+                        doc._data[ name ] = field.to_python( son[ field.db_field ] )
+
+                # Only now is it fully loaded; documents that no longer exist stay partial
+                self._partial.pop( str( doc.pk ), None )
+
+                # Treat the newly loaded values as the current database state
+                if hasattr( doc, '_memoize_fields' ):
+                    doc._memoize_fields( missing_fields )
+                    doc.update_relations()
+
     def remove( self, documents ):
         '''
         Remove one or more documents from the cache.
@@ -133,12 +837,67 @@ class DocumentCache( object ):
         '''
         if isinstance( documents, ( DBRef, Document ) ):
             if documents.id:
-                del self._documents[ str( documents.id ) ]
+                self._remove_single_document( documents.id )
 
         elif isinstance( documents, ObjectId ):
-            del self._documents[ str( documents ) ]
+            self._remove_single_document( documents )
 
         elif isinstance( documents, ( list, set, QuerySet ) ):
             for obj in documents:
                 if obj.pk:
-                    del self._documents[ str( obj.pk ) ]
\ No newline at end of file
+                    self._remove_single_document( obj.pk )
+
+    def _remove_single_document( self, object_id ):
+        key = str( object_id )
+        # Keys of removed documents are dropped from `_order` when evicting. A weakly held document may be
+        # gone already, but its other state isn't.
+        self._documents.pop( key, None )
+        self._partial.pop( key, None )
+        self._retained.pop( key, None )
+        self._expires.pop( key, None )
+
+class ThreadSafeDocumentCache( DocumentCache ):
+    '''
+    A `DocumentCache` that can be shared between threads. Inserting a document is an atomic get-or-insert,
+    so there's only ever one cached instance per id. Entries are guarded by `stripes` locks, selected by
+    id, so threads working on different documents rarely contend.
+    '''
+    def __init__( self, request=None, missing_ttl=None, weak=False, stripes=16 ):
+        super( ThreadSafeDocumentCache, self ).__init__( request, missing_ttl=missing_ttl, weak=weak )
+        self._locks = [ threading.RLock() for i in range( stripes ) ]
+        self._order_lock = threading.RLock()
+
+    def _get_lock( self, key ):
+        return self._locks[ hash( key ) % len( self._locks ) ]
+
+    def _store( self, key, value ):
+        with self._get_lock( key ):
+            return super( ThreadSafeDocumentCache, self )._store( key, value )
+
+    def _insert( self, key, value ):
+        with self._get_lock( key ):
+            doc = self._documents.get( key )
+            if doc is not None:
+                return doc
+
+            stored = self._store( key, value )
+
+        # Follow up outside of the lock; attaching the request may add other documents
+        if stored:
+            self._stored( key, value )
+
+        return value
+
+    def _evict( self, document_type, max_entries, key=None ):
+        # Evicting takes the locks of the evicted documents; never the other way around
+        with self._order_lock:
+            super( ThreadSafeDocumentCache, self )._evict( document_type, max_entries, key )
+
+    def _get_proxy( self, key, dbref, document_type ):
+        with self._get_lock( key ):
+            return super( ThreadSafeDocumentCache, self )._get_proxy( key, dbref, document_type )
+
+    def _remove_single_document( self, object_id ):
+        key = str( object_id )
+        with self._get_lock( key ):
+            super( ThreadSafeDocumentCache, self )._remove_single_document( key )
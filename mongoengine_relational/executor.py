@@ -0,0 +1,129 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import threading
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    # On Python 2, `concurrent.futures` is provided by the optional `futures` package
+    Future = ThreadPoolExecutor = None
+
+
+DEFAULT_MAX_WORKERS = 8
+
+# Re-raise an exception with its original traceback; the syntax for that differs between Python 2 and 3
+if sys.version_info[ 0 ] < 3:
+    exec( 'def _reraise( exc_type, exc_value, traceback ):\n    raise exc_type, exc_value, traceback\n' )
+else:
+    def _reraise( exc_type, exc_value, traceback ):
+        raise exc_value.with_traceback( traceback )
+
+_executor = None
+
+
+if Future is not None:
+    class AwaitableFuture( Future ):
+        '''
+        A `concurrent.futures.Future` that can be awaited directly from asyncio code.
+        '''
+        def __await__( self ):
+            import asyncio
+            return asyncio.wrap_future( self ).__await__()
+
+
+def get_executor():
+    '''
+    Get the executor that asynchronous operations run on; a `ThreadPoolExecutor` unless `set_executor`
+    has been used to provide another.
+
+    @rtype: concurrent.futures.Executor
+    '''
+    global _executor
+
+    if _executor is None:
+        if ThreadPoolExecutor is None:
+            raise RuntimeError( 'Asynchronous operations require `concurrent.futures` (the `futures` package on Python 2)' )
+
+        _executor = ThreadPoolExecutor( max_workers=DEFAULT_MAX_WORKERS )
+
+    return _executor
+
+
+def set_executor( executor ):
+    '''
+    Run asynchronous operations on `executor`; pass `None` to go back to the default.
+
+    @type executor: concurrent.futures.Executor
+    '''
+    global _executor
+    _executor = executor
+
+
+def submit( function, *args, **kwargs ):
+    '''
+    Run `function` on the executor.
+
+    @rtype: AwaitableFuture
+    '''
+    executor = get_executor()
+    future = AwaitableFuture()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            result = function( *args, **kwargs )
+        except BaseException as e:
+            future.set_exception( e )
+        else:
+            future.set_result( result )
+
+    executor.submit( run )
+    return future
+
+
+def run_parallel( calls, max_workers=DEFAULT_MAX_WORKERS ):
+    '''
+    Run `calls` at the same time, on at most `max_workers` short-lived threads (so it's safe to use from
+    within the executor). If any call raises, the first exception is re-raised once all calls have finished.
+
+    @param calls: a list of `( function, args )` tuples
+    @type calls: list
+    @return: the results of `calls`, in order
+    @rtype: list
+    '''
+    if len( calls ) <= 1:
+        return [ function( *args ) for function, args in calls ]
+
+    results = [ None ] * len( calls )
+    errors = []
+    pending = iter( enumerate( calls ) )
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                try:
+                    index, ( function, args ) = next( pending )
+                except StopIteration:
+                    return
+
+            try:
+                results[ index ] = function( *args )
+            except Exception:
+                errors.append( ( index, sys.exc_info() ) )
+
+    threads = [ threading.Thread( target=work ) for i in range( min( max_workers, len( calls ) ) ) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        index, ( exc_type, exc_value, traceback ) = min( errors, key=lambda error: error[ 0 ] )
+        _reraise( exc_type, exc_value, traceback )
+
+    return results
@@ -0,0 +1,211 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import abc
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import uuid
+
+
+class InvalidationBus( object ):
+    '''
+    Carries `( collection, id )` invalidations between processes that share documents through
+    a `DocumentCache` (see `DocumentCache.use_bus`).
+
+    Subclasses implement a transport by overriding `_send`, and pass any data they receive to `receive`.
+    Messages sent by a bus are never delivered to its own subscribers.
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    def __init__( self ):
+        self.id = uuid.uuid4().hex
+        self._subscribers = []
+
+    def subscribe( self, callback ):
+        '''
+        @param callback: called with `collection` and `object_id` for every invalidation received
+        @type callback: callable
+        '''
+        if callback not in self._subscribers:
+            self._subscribers.append( callback )
+
+    def unsubscribe( self, callback ):
+        if callback in self._subscribers:
+            self._subscribers.remove( callback )
+
+    def publish( self, collection, object_id ):
+        '''
+        Send an invalidation for the document `object_id` in `collection` to other processes.
+
+        @type collection: string
+        @type object_id: string
+        '''
+        data = json.dumps( { 'sender': self.id, 'collection': collection, 'id': object_id } )
+        self._send( data.encode( 'utf-8' ) )
+
+    def receive( self, data ):
+        '''
+        Deliver an invalidation received by the transport to all subscribers.
+
+        @type data: bytes
+        '''
+        try:
+            message = json.loads( data.decode( 'utf-8' ) )
+        except ValueError:
+            return
+
+        if message.get( 'sender' ) == self.id:
+            return
+
+        for callback in list( self._subscribers ):
+            callback( message[ 'collection' ], message[ 'id' ] )
+
+    def close( self ):
+        pass
+
+    @abc.abstractmethod
+    def _send( self, data ):
+        '''
+        Deliver `data` to the buses of other processes.
+
+        @type data: bytes
+        '''
+
+
+class MemoryBus( InvalidationBus ):
+    '''
+    Delivers invalidations synchronously to all other `MemoryBus`es on the same `channel`, within a single
+    process. Meant for tests.
+    '''
+    _channels = collections.defaultdict( list )
+
+    def __init__( self, channel='default' ):
+        super( MemoryBus, self ).__init__()
+        self.channel = channel
+        self._channels[ channel ].append( self )
+
+    def _send( self, data ):
+        for bus in list( self._channels[ self.channel ] ):
+            bus.receive( data )
+
+    def close( self ):
+        if self in self._channels[ self.channel ]:
+            self._channels[ self.channel ].remove( self )
+
+
+class SocketBus( InvalidationBus ):
+    '''
+    Base class for datagram socket transports. Call `listen` to process incoming invalidations on a background
+    thread, or call `poll` periodically.
+    '''
+    buffer_size = 4096
+
+    def __init__( self ):
+        super( SocketBus, self ).__init__()
+        self._socket = None
+        self._thread = None
+        self._closed = False
+
+    def listen( self ):
+        '''
+        Start receiving invalidations on a daemon thread.
+        '''
+        if self._thread is None:
+            self._socket.settimeout( None )
+            self._thread = threading.Thread( target=self._listen, name='InvalidationBus' )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _listen( self ):
+        while not self._closed:
+            try:
+                self.receive( self._socket.recv( self.buffer_size ) )
+            except socket.error:
+                if self._closed:
+                    break
+
+    def poll( self ):
+        '''
+        Process all invalidations that have been received, without blocking. Does nothing once `listen` has
+        been called, since the listener thread processes them.
+
+        @return: the number of messages processed
+        @rtype: int
+        '''
+        count = 0
+        if self._thread is not None:
+            return count
+
+        self._socket.setblocking( False )
+
+        try:
+            while True:
+                self.receive( self._socket.recv( self.buffer_size ) )
+                count += 1
+        except socket.error:
+            pass
+        finally:
+            # A listener started later needs a blocking socket; otherwise it would spin on `recv`
+            self._socket.setblocking( True )
+
+        return count
+
+    def close( self ):
+        self._closed = True
+        if self._socket is not None:
+            self._socket.close()
+
+
+class UnixSocketBus( SocketBus ):
+    '''
+    Sends invalidations to the Unix datagram sockets at `peers`, and receives them on the socket at `path`.
+    Typically, each worker process on a host binds its own `path`, with all other workers' paths as `peers`.
+    '''
+    def __init__( self, path, peers ):
+        super( UnixSocketBus, self ).__init__()
+        self.path = path
+        self.peers = [ peer for peer in peers if peer != path ]
+
+        if os.path.exists( path ):
+            os.unlink( path )
+
+        self._socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+        self._socket.bind( path )
+
+    def _send( self, data ):
+        for peer in self.peers:
+            try:
+                self._socket.sendto( data, peer )
+            except socket.error:
+                # A peer that isn't running (yet) has nothing cached
+                pass
+
+    def close( self ):
+        super( UnixSocketBus, self ).close()
+        if os.path.exists( self.path ):
+            os.unlink( self.path )
+
+
+class MulticastBus( SocketBus ):
+    '''
+    Sends and receives invalidations through UDP multicast `group` on `port`.
+    '''
+    def __init__( self, group='239.255.42.99', port=42099, ttl=1 ):
+        super( MulticastBus, self ).__init__()
+        self.group = group
+        self.port = port
+
+        self._socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP )
+        self._socket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        self._socket.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl )
+        self._socket.bind( ( '', port ) )
+
+        membership = struct.pack( '4sl', socket.inet_aton( group ), socket.INADDR_ANY )
+        self._socket.setsockopt( socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership )
+
+    def _send( self, data ):
+        self._socket.sendto( data, ( self.group, self.port ) )
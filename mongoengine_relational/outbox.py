@@ -0,0 +1,103 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+
+from bson import ObjectId
+from mongoengine.connection import get_db
+
+
+# The collection that change records are written to
+OUTBOX_COLLECTION = 'relational_outbox'
+
+
+def record_changes( doc, changes ):
+    '''
+    Write a change record to the outbox for every relation in `changes`, with the database of `doc`'s
+    collection. Inside a `WriteBatch` (which is how documents with an outbox are written), the records are
+    part of the batch, and get their id when the batch executes.
+
+    Records look like `{ '_id': ObjectId, 'collection': 'zoo', 'doc': ObjectId, 'field': 'animals',
+    'added': [ ObjectId, ... ], 'removed': [ ObjectId, ... ], 'version': 2 }`, where `version` is
+    the document's `version_field` (if it has one).
+
+    @param changes: the added and removed ids per field name
+    @type changes: dict
+    '''
+    version_field = doc._meta.get( 'version_field' )
+    collection = doc._get_collection()
+    outbox = collection.database[ OUTBOX_COLLECTION ]
+
+    # Check the class; pymongo collections turn any attribute into a sub-collection
+    insert = outbox.append if callable( getattr( type( outbox ), 'append', None ) ) else outbox.insert
+
+    for field_name, ( added, removed ) in changes.items():
+        insert( {
+            'collection': collection.name,
+            'doc': doc.pk,
+            'field': field_name,
+            'added': list( added ),
+            'removed': list( removed ),
+            'version': doc._data.get( version_field ) if version_field else None
+        } )
+
+
+class ChangeFeed( object ):
+    '''
+    Iterates over the change records in the outbox (see `record_changes`), oldest first. After (or while)
+    iterating, `resume_token` identifies the last record seen; pass it to a new feed to continue from there:
+
+        feed = ChangeFeed( collections=[ 'zoo' ], resume_token=token )
+        for record in feed:
+            index( record )
+        token = feed.resume_token
+
+    Records are ordered by their ObjectId, which the writer assigns when its `WriteBatch` executes, right
+    before sending it. That's only roughly the order in which they're stored: a record is visible once its
+    transaction commits, and ObjectIds from different processes are as far apart as their clocks. To not
+    skip records, records from the last `settle` seconds are left for later; it should exceed the clock skew
+    between writers plus the time a batch takes to execute (and commit).
+    '''
+    def __init__( self, collections=None, fields=None, resume_token=None, settle=1, batch_size=100, database=None ):
+        '''
+        @param collections: only include changes to documents in these collections
+        @type collections: list<string>
+        @param fields: only include changes to these fields
+        @type fields: list<string>
+        @param resume_token: continue after the record this token identifies
+        @type resume_token: string
+        @param settle: the number of seconds records are left for; `None` to include all records
+        @type settle: int
+        @param database: the database holding the outbox; the default connection's database if not given
+        '''
+        self.collections = collections
+        self.fields = fields
+        self.resume_token = resume_token
+        self.settle = settle
+        self.batch_size = batch_size
+        self.database = database if database is not None else get_db()
+
+    def _get_query( self ):
+        query = {}
+        ids = {}
+
+        if self.resume_token:
+            ids[ '$gt' ] = ObjectId( self.resume_token )
+        if self.settle is not None:
+            ids[ '$lt' ] = ObjectId.from_datetime( datetime.datetime.utcnow() - datetime.timedelta( seconds=self.settle ) )
+
+        if ids:
+            query[ '_id' ] = ids
+        if self.collections:
+            query[ 'collection' ] = { '$in': list( self.collections ) }
+        if self.fields:
+            query[ 'field' ] = { '$in': list( self.fields ) }
+
+        return query
+
+    def __iter__( self ):
+        cursor = self.database[ OUTBOX_COLLECTION ].find( self._get_query() ).sort( '_id', 1 ).batch_size( self.batch_size )
+
+        for record in cursor:
+            self.resume_token = str( record[ '_id' ] )
+            yield record
@@ -0,0 +1,113 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from mongoengine import Document
+from bson import DBRef
+
+
+class DocumentProxy( object ):
+    '''
+    A stand-in for a referenced Document that hasn't been fetched yet.
+
+    A proxy knows the `DBRef` it points to, so it can answer `pk`/`id`, equality and
+    `DocumentCache` membership checks without touching the database. The actual Document
+    is loaded on first access to any other attribute; all proxies pending in the same
+    `DocumentCache` for that Document class are fetched along with it in a single query.
+
+    Proxies are returned by `ReferenceField`s created with `lazy=True`.
+    '''
+    __slots__ = ( '_dbref', '_document_type', '_cache', '_document' )
+
+    def __init__( self, dbref, document_type, cache ):
+        object.__setattr__( self, '_dbref', dbref )
+        object.__setattr__( self, '_document_type', document_type )
+        object.__setattr__( self, '_cache', cache )
+        object.__setattr__( self, '_document', None )
+
+    # Pretend to be an instance of `document_type`, so `isinstance` checks and Document
+    # equality (which compares classes) work without loading the document.
+    @property
+    def __class__( self ):
+        return self._document_type
+
+    @property
+    def pk( self ):
+        return self._dbref.id
+
+    @property
+    def id( self ):
+        return self._dbref.id
+
+    def to_dbref( self ):
+        return self._dbref
+
+    def is_loaded( self ):
+        return self._document is not None
+
+    def _get_document( self ):
+        '''
+        Return the proxied Document, loading it (and all other pending proxies of the same
+        Document class) through the cache if that hasn't happened yet.
+
+        @rtype: Document
+        '''
+        if self._document is None:
+            doc = self._cache.get( self._dbref )
+
+            if doc is None:
+                self._cache.load_proxies( self._document_type )
+                doc = self._cache.get( self._dbref )
+
+            if doc is None:
+                raise self._document_type.DoesNotExist( 'Cannot find Document for DBRef={}'.format( self._dbref ) )
+
+            object.__setattr__( self, '_document', doc )
+
+        return self._document
+
+    def __getattr__( self, name ):
+        return getattr( self._get_document(), name )
+
+    def __setattr__( self, name, value ):
+        if name in DocumentProxy.__slots__:
+            return object.__setattr__( self, name, value )
+
+        return setattr( self._get_document(), name, value )
+
+    def __getitem__( self, name ):
+        return self._get_document()[ name ]
+
+    def __setitem__( self, name, value ):
+        self._get_document()[ name ] = value
+
+    def __eq__( self, other ):
+        if isinstance( other, DocumentProxy ):
+            return self.pk == other.pk
+        elif isinstance( other, Document ):
+            return self.pk == other.pk
+        elif isinstance( other, DBRef ):
+            return self.pk == other.id
+
+        return self.pk == other
+
+    def __ne__( self, other ):
+        return not self.__eq__( other )
+
+    def __hash__( self ):
+        # Hash like a Document with a `pk` would, so proxies and Documents can be mixed in sets
+        return hash( self.pk )
+
+    def __nonzero__( self ):
+        return True
+
+    def __unicode__( self ):
+        if self._document is not None:
+            return unicode( self._document )
+
+        return '{} proxy (id={})'.format( self._document_type._class_name, self.pk )
+
+    def __str__( self ):
+        return unicode( self ).encode( 'utf-8' )
+
+    def __repr__( self ):
+        return '<DocumentProxy: {}>'.format( self.__unicode__() )
@@ -0,0 +1,23 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from .scope import CacheScope
+
+
+def cache_scope_tween_factory( handler, registry ):
+    '''
+    A Pyramid tween that handles each request in a `CacheScope`, with the request as its unit of work.
+    Documents saved or deleted while handling the request use it, without having to pass it explicitly.
+    '''
+    def cache_scope_tween( request ):
+        with CacheScope( request ):
+            return handler( request )
+
+    return cache_scope_tween
+
+
+def includeme( config ):
+    '''
+    Activate with `config.include( 'mongoengine_relational.pyramid_adapter' )`.
+    '''
+    config.add_tween( 'mongoengine_relational.pyramid_adapter.cache_scope_tween_factory' )
@@ -0,0 +1,181 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+from mongoengine import Document
+from mongoengine.queryset import QuerySet
+
+from .cache import DocumentCache
+from .scope import get_current_scope
+
+
+class RelationalQuerySet( QuerySet ):
+    '''
+    A QuerySet that uses a `DocumentCache` as identity map: the cache of the `CacheScope` that is active when
+    the QuerySet is created, or the one attached using `with_cache`.
+
+    Lookups by id (`get( id=... )`, `filter( id__in=[ ... ] )`, `with_id`) are answered from the cache first;
+    only ids that aren't cached are queried. For all other results, documents that are already cached are
+    returned as-is, before a new Document would be built from the query result; others are added to the cache.
+
+    Inside a `CacheScope`, this means queries return the scope's instances, including any changes that haven't
+    been saved (or that are queued by `coalesce_writes`): the fields of a cached document aren't refreshed from
+    the query result, so they can differ from what's stored, and from the query's criteria. Use
+    `with_cache( None )` to get the stored state.
+
+    This is the default `queryset_class` for documents using the `RelationManagerMixin`.
+    '''
+    _document_cache = None
+    _cached_results = None
+
+    # When the results started coming in; documents read since are shared with other caches (see `DocumentCache.share`)
+    _read_at = None
+
+    def __init__( self, *args, **kwargs ):
+        super( RelationalQuerySet, self ).__init__( *args, **kwargs )
+
+        scope = get_current_scope()
+        if scope is not None:
+            self._document_cache = scope.cache
+
+    def with_cache( self, cache ):
+        '''
+        Get a clone of this QuerySet that uses `cache` as identity map.
+
+        @param cache: a `DocumentCache`, or a request or `CacheScope` that holds one; `None` to not use a cache
+        @type cache: DocumentCache or Request or CacheScope
+        @rtype: RelationalQuerySet
+        '''
+        if cache is not None and not isinstance( cache, DocumentCache ):
+            cache = cache.cache
+
+        queryset = self.clone()
+        queryset._document_cache = cache
+        return queryset
+
+    def clone_into( self, cls ):
+        cls = super( RelationalQuerySet, self ).clone_into( cls )
+
+        if isinstance( cls, RelationalQuerySet ):
+            cls._document_cache = self._document_cache
+
+        return cls
+
+    def next( self ):
+        if self._cached_results is None:
+            object_ids = self._get_queried_ids()
+            self._cached_results = iter( self._fetch_cached( object_ids ) ) if object_ids is not None else False
+
+        if self._cached_results is not False:
+            return next( self._cached_results )
+
+        if self._limit == 0 or self._none:
+            raise StopIteration
+
+        if self._read_at is None:
+            self._read_at = time.time()
+
+        return self._load( self._cursor.next() )
+
+    def rewind( self ):
+        self._cached_results = None
+        self._read_at = None
+        super( RelationalQuerySet, self ).rewind()
+
+    def __getitem__( self, key ):
+        if isinstance( key, int ):
+            if self._get_queried_ids() is not None:
+                return list( self.clone() )[ key ]
+
+            queryset = self.clone()
+            queryset._read_at = time.time()
+            return queryset._load( queryset._cursor.next() if queryset._as_pymongo else queryset._cursor[ key ] )
+
+        return super( RelationalQuerySet, self ).__getitem__( key )
+
+    def in_bulk( self, object_ids ):
+        if self._document_cache is None or self._as_pymongo:
+            return super( RelationalQuerySet, self ).in_bulk( object_ids )
+
+        self._read_at = time.time()
+        return self._load_bulk( self._find_bulk( object_ids ) )
+
+    def _find_bulk( self, object_ids ):
+        '''
+        Query the raw results for `object_ids`. This doesn't touch the cache, so it can run on any thread.
+
+        @type object_ids: list
+        @rtype: list<dict>
+        '''
+        return list( self._collection.find( { '_id': { '$in': object_ids } }, **self._cursor_args ) )
+
+    def _load_bulk( self, sons ):
+        '''
+        Turn raw results (as returned by `_find_bulk`) into Documents, like `in_bulk`.
+
+        @type sons: list<dict>
+        @rtype: dict
+        '''
+        return dict( ( son[ '_id' ], self._load( son ) ) for son in sons )
+
+    def _load( self, son ):
+        '''
+        Turn a raw result into a Document (or a scalar or dict, depending on how this QuerySet is set up).
+        If the document is already cached, the cached instance is used instead of building a duplicate;
+        otherwise the new Document is added to the cache.
+
+        @type son: dict
+        '''
+        if self._as_pymongo:
+            return self._get_as_pymongo( son )
+
+        doc = self._document_cache.get( son.get( '_id' ) ) if self._document_cache is not None else None
+
+        # A partially loaded document can't stand in for a query result
+        if not isinstance( doc, self._document ) or self._document_cache.is_partial( doc ):
+            doc = self._document._from_son( son, _auto_dereference=self._auto_dereference )
+
+            # Don't cache documents that have only been loaded partially by this QuerySet
+            if self._document_cache is not None and not self._loaded_fields:
+                doc = self._document_cache.add( doc )
+                self._document_cache.share( doc, self._read_at )
+
+        return self._get_scalar( doc ) if self._scalar else doc
+
+    def _get_queried_ids( self ):
+        '''
+        Determine if this QuerySet only selects documents by id, in a way that can be answered from the cache.
+
+        @return: the queried ids, or None if the query can't be answered from the cache
+        @rtype: list or None
+        '''
+        if ( self._document_cache is None or self._none or self._scalar or self._as_pymongo or
+                self._skip or self._where_clause or self._ordering or self._loaded_fields ):
+            return None
+
+        query = dict( self._query )
+        for key, value in self._initial_query.items():
+            if query.get( key ) == value:
+                del query[ key ]
+
+        if query.keys() != [ '_id' ]:
+            return None
+
+        value = query[ '_id' ]
+        if isinstance( value, dict ):
+            return list( value[ '$in' ] ) if value.keys() == [ '$in' ] else None
+
+        return [ value ]
+
+    def _fetch_cached( self, object_ids ):
+        '''
+        Get the documents for `object_ids` through the cache, which only queries the ids it doesn't hold yet.
+
+        @type object_ids: list
+        @rtype: Document[]
+        '''
+        docs = [ doc for doc in self._document_cache.fetch( self._document, object_ids )
+                    if isinstance( doc, self._document ) ]
+
+        return docs[ :self._limit ] if self._limit is not None else docs
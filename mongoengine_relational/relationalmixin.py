@@ -1,18 +1,28 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from pyramid.request import Request
-
 from mongoengine import Document, GenericReferenceField, ReferenceField, ListField, ValidationError
-from mongoengine.base import ComplexBaseField
+from mongoengine.base import ComplexBaseField, get_document
 from mongoengine.common import _import_class
 from mongoengine import base
 from mongoengine.queryset import CASCADE, DO_NOTHING, NULLIFY, DENY, PULL
 from bson import DBRef, ObjectId, SON
 
+import collections
 import copy
+import itertools
+import time
+
+from .cache import DocumentCache, ThreadSafeDocumentCache
+from .proxy import DocumentProxy
+from .queryset import RelationalQuerySet
+from .scope import get_current_request, get_current_scope
+from .executor import submit
+from .outbox import record_changes
 
-from .cache import DocumentCache
+
+# The number of times a write to a versioned document is retried after a conflict
+DEFAULT_VERSION_RETRIES = 3
 
 # from kitchen.text.converters import getwriter
 # import sys
@@ -129,6 +139,11 @@ class BaseList( list ):
         return super( BaseList, self ).sort( *args, **kwargs )
 
     def _mark_as_changed( self ):
+        # Every change passes through here before it's made; relations derived from the other side can't be changed
+        if getattr( self._instance, '_external_fields', {} ).get( self._name ) == 'reverse':
+            raise RelationalError( "`{}` is derived from `{}` on the related documents, and can't be changed directly".format(
+                self._name, self._instance._fields[ self._name ].related_name ) )
+
         if hasattr( self._instance, '_mark_as_changed' ):
             self._instance._mark_as_changed( self._name )
 
@@ -140,6 +155,13 @@ class RelationalError( Exception ):
     pass
 
 
+class VersionConflictError( RelationalError ):
+    '''
+    Raised when a versioned document can't be written, because it kept being changed by others.
+    '''
+    pass
+
+
 class ReferenceField( ReferenceField ):
     '''
     Adds a `related_name` argument to MongoEngine's `ReferenceField` for use in
@@ -148,10 +170,18 @@ class ReferenceField( ReferenceField ):
     The `related_name` should point to a `ListField`, `ReferenceField` or
     `GenericReferenceField`.  The corresponding field may or may not have a
     `related_name` argument pointing back here.
+
+    When `lazy=True`, a reference that can't be found in the cache is returned
+    as a `DocumentProxy` instead of being dereferenced right away.
+
+    When `only` is given (a list of field names), dereferencing only loads those
+    fields of the referenced document.
     '''
     
     def __init__(self, document_type, **kwargs):
         related_name = kwargs.pop( 'related_name', None )
+        self.lazy = kwargs.pop( 'lazy', False )
+        self.only = kwargs.pop( 'only', None )
         super( ReferenceField, self ).__init__( document_type, **kwargs )
         if related_name and isinstance( related_name, basestring ):
             self.related_name = related_name
@@ -174,15 +204,21 @@ class ReferenceField( ReferenceField ):
                 result = instance._fetch( self.name )
 
             if value and not result:
-                value = self.document_type._get_db().dereference( value )
-                if value is not None:
-                    result = self.document_type._from_son( value )
-                    instance._data[self.name] = result
+                # Hand out a proxy; it will be loaded (batched with other pending proxies) on first real use
+                if self.lazy and hasattr( instance, '_cache' ):
+                    return instance._cache.proxy( value, self.document_type )
 
-                    if hasattr( instance, '_cache' ):
-                        instance._cache.add( result )
+                if hasattr( instance, '_cache' ):
+                    docs = instance._cache.fetch( self.document_type, [ value ], only=instance._get_projection( self.name ) )
+                    if docs:
+                        instance._data[self.name] = docs[ 0 ]
+                else:
+                    value = self.document_type._get_db().dereference( value )
+                    if value is not None:
+                        instance._data[self.name] = self.document_type._from_son( value )
 
-        return super( ReferenceField, self ).__get__( instance, owner )
+        # Skip MongoEngine's `ReferenceField.__get__`; it would try to dereference a dangling reference again
+        return base.BaseField.__get__( self, instance, owner )
 
 
 class GenericReferenceField( GenericReferenceField ):
@@ -214,7 +250,17 @@ class GenericReferenceField( GenericReferenceField ):
                 result = instance._fetch( self.name )
 
             if value and not result:
-                result = self.dereference( value )
+                document_type = get_document( value[ '_cls' ] )
+
+                # Don't query again for references that are known to be dangling
+                if hasattr( instance, '_cache' ) and instance._cache.is_missing( document_type, value[ '_ref' ] ):
+                    result = None
+                else:
+                    result = self.dereference( value )
+
+                    if result is None and hasattr( instance, '_cache' ):
+                        instance._cache.add_missing( document_type, value[ '_ref' ] )
+
                 instance._data[self.name] = result
 
                 if hasattr( instance, '_cache' ):
@@ -231,10 +277,30 @@ class ListField( ListField ):
     The `related_name` should point to a `ReferenceField`. The corresponding
     `ReferenceField` may or may not have a `related_name` argument pointing
     back here.
+
+    When `only` is given (a list of field names), dereferencing only loads those
+    fields of the referenced documents.
+
+    With `storage='edges'`, the references aren't stored in the document itself,
+    but as separate (indexed) documents in an edge collection. This keeps very large
+    relations out of the parent document. The edge collection is named after the
+    document's collection and the field, unless `edge_collection` is given.
+    Edges are loaded on first access, and are returned in the order they were added.
+
+    With `storage='reverse'`, the relation isn't stored at all, but derived from the
+    `ReferenceField` on the other side (which `related_name` should point to) using an
+    indexed query. The relation is loaded on first access, ordered by the ids of the
+    related documents (so in the order they were created); the result is kept on this
+    document (and the related documents in the request's cache) for later access.
+    The relation is read-only: it's changed by setting the `ReferenceField` on the related
+    documents, and persisted by saving those, so every relation change takes a single write.
     '''
 
     def __init__(self, field=None, **kwargs):
         related_name = kwargs.pop('related_name', None)
+        self.only = kwargs.pop( 'only', None )
+        self.storage = kwargs.pop( 'storage', None )
+        self.edge_collection = kwargs.pop( 'edge_collection', None )
         super(ListField, self).__init__(field=field, **kwargs)
         if related_name and isinstance(related_name, basestring):
             self.related_name = related_name
@@ -249,6 +315,10 @@ class ListField( ListField ):
         # We only care about lists that contain documents/references here.
         # Code is adapted from `ComplexBaseField.__get__`.
         if isinstance( self.field, ( GenericReferenceField, ReferenceField ) ):
+            # Relations that aren't stored in the document itself have to be loaded first
+            if self.storage and instance._initialised and hasattr( instance, '_load_external' ):
+                instance._load_external( self.name )
+
             # dereference = self._auto_dereference
             _dereference = _import_class("DeReference")()
 
@@ -270,10 +340,18 @@ class ListField( ListField ):
 
             # If we have raw values, obtain documents; either from cache, or by dereferencing
             if self._auto_dereference and instance._initialised and isinstance( value, BaseList ) and not value._dereferenced:
-                # If we can find all objects in the cache, use it. Otherwise, retrieve all of them.
-                if hasattr( instance, '_cache' ) and all( instance._cache[ doc ] for doc in value ):
+                # Load missing (or partially loaded) documents into the cache with a single query
+                if hasattr( instance, '_cache' ) and isinstance( self.field, ReferenceField ):
+                    instance._cache.fetch( self.field.document_type, value, only=instance._get_projection( self.name ) )
+
+                # If we can find all objects in the cache (apart from references known to be dangling), use it.
+                # Otherwise, retrieve all of them.
+                if hasattr( instance, '_cache' ) and all( instance._cache[ doc ] or
+                        ( isinstance( self.field, ReferenceField ) and instance._cache.is_missing( self.field.document_type, doc ) )
+                        for doc in value ):
                     for index, doc in enumerate( value ):
-                        super( BaseList, value ).__setitem__( index, instance._cache[ doc ] )
+                        if instance._cache[ doc ]:
+                            super( BaseList, value ).__setitem__( index, instance._cache[ doc ] )
                 else:
                     value = _dereference(
                         value, max_depth=1, instance=instance, name=self.name
@@ -299,6 +377,49 @@ class ListField( ListField ):
 
         return value
 
+    def get_edge_collection( self ):
+        '''
+        Get the (pymongo) collection that stores the references for this field when `storage='edges'`.
+        Each edge is stored as `{ src: <owner id>, dst: <related id> }`. Its indexes are created by
+        `ensure_relation_indexes`.
+        '''
+        # Read `_owner_document` directly; the `owner_document` property has no working getter in MongoEngine
+        document_type = self._owner_document
+        name = self.edge_collection or '{}.{}'.format( document_type._get_collection_name(), self.name )
+        return document_type._get_db()[ name ]
+
+
+class _ConditionalCollection( object ):
+    '''
+    Stands in for a document's collection during a versioned save: updates only apply to a stored document
+    that matches `condition` (and never insert). A `VersionConflictError` is raised when none matched.
+    When a `WriteBatch` records the update, it can't tell yet; it calls `retry` when the update doesn't
+    match on execution instead.
+    '''
+    def __init__( self, collection, condition, retry=None ):
+        self._collection = collection
+        self._condition = condition
+        self._retry = retry
+
+    def __getattr__( self, name ):
+        return getattr( self._collection, name )
+
+    def update( self, spec, document, upsert=False, **kwargs ):
+        spec = dict( spec )
+        spec.update( self._condition )
+
+        # Check the class; pymongo collections turn any attribute into a sub-collection
+        if self._retry and callable( getattr( type( self._collection ), 'defer', None ) ):
+            kwargs[ 'retry' ] = self._retry
+
+        last_error = self._collection.update( spec, document, upsert=False, **kwargs )
+
+        # Unacknowledged writes can't be checked for conflicts
+        if last_error is not None and not last_error.get( 'n' ):
+            raise VersionConflictError( 'No document in `{}` matched {}'.format( self._collection.name, spec ) )
+
+        return last_error
+
 
 class RelationManagerMixin( object ):
     """ 
@@ -338,7 +459,18 @@ class RelationManagerMixin( object ):
     
     (Potential) todo: `rebuild` functionality that can repair, or at least
     report, any differences between managed fields.
+
+    Concurrent saves can be guarded with optimistic concurrency control, by
+    naming an `IntField` as `version_field` in `meta` (and optionally
+    `version_retries`). Writes to an existing document are then conditional
+    on its stored version, which is incremented on every write. When another
+    process has written in the meantime, our changes to hasmany relations are
+    re-applied to the stored references, and the write is retried.
     """
+    meta = {
+        'queryset_class': RelationalQuerySet
+    }
+
     def __init__( self, *args, **kwargs ):
         super( RelationManagerMixin, self ).__init__( *args, **kwargs )
 
@@ -380,10 +512,18 @@ class RelationManagerMixin( object ):
                         # So mark it as changed
                         self._mark_as_changed( key )
 
+                # Relations can only be maintained on actual documents; make sure a proxy is loaded
+                if isinstance( value, DocumentProxy ):
+                    value = value._get_document()
+
                 value = self._cache.get( value, value )
                 self.update_hasone( key, value )
 
             elif key in self._memo_hasmany:
+                if self._external_fields.get( key ) == 'reverse':
+                    raise RelationalError( "`{}` is derived from `{}` on the related documents, and can't be changed directly".format(
+                        key, self._fields[ key ].related_name ) )
+
                 value = [ self._cache.get( item, item ) for item in value ]
                 self.update_hasmany( key, value, self[ key ] )
 
@@ -397,6 +537,11 @@ class RelationManagerMixin( object ):
         self._memo_hasmany = {}
         self._memo_simple = {}
 
+        # Relations that aren't stored in the document itself (mapping field names to their `storage`),
+        # and the ones that have been loaded
+        self._external_fields = {}
+        self._loaded_external = set()
+
         for name, field in self._fields.iteritems():
             if isinstance( field, ReferenceField ) or isinstance( field, GenericReferenceField ):
                 self._memo_hasone[ name ] = None
@@ -406,6 +551,9 @@ class RelationManagerMixin( object ):
                 if isinstance( field.field, ReferenceField ) or isinstance( field.field, GenericReferenceField ):
                     self._memo_hasmany[ name ] = set()
                     related_doc_type = getattr( field.field, 'document_type', None )
+
+                    if field.storage:
+                        self._external_fields[ name ] = field.storage
                 else:
                     related_doc_type = None
             else:
@@ -430,6 +578,8 @@ class RelationManagerMixin( object ):
                     raise RelationalError( "You should add `related_name={}` to the definition of `{}` on the `{}` Document".format( name, related_field.name, related_doc_type._class_name ) )
                 elif related_field.related_name != name:
                     raise RelationalError( "The field `{}` of `{}` has `related_name='{}'`; should this be `related_name='{}'`?".format( related_field.name, related_doc_type._class_name, related_field.related_name, name ) )
+                elif getattr( field, 'storage', None ) == 'reverse' and not isinstance( related_field, ReferenceField ):
+                    raise RelationalError( "The field `{}` has `storage='reverse'`, so `{}` on the `{}` Document should be a `ReferenceField`".format( name, related_field.name, related_doc_type._class_name ) )
 
                     # print( '  {0} <-> {1}.{2}'.format( name, related_doc_type._class_name, related_field.name ) )
 
@@ -451,6 +601,11 @@ class RelationManagerMixin( object ):
 
             related_doc_type = getattr( field, 'document_type', None )
             related_field = getattr( related_doc_type, related_name, None )
+
+            # Relations that aren't stored in the document itself can't be pulled from; they're cleaned up by us
+            if getattr( related_field, 'storage', None ):
+                continue
+
             if related_field:
                 if isinstance( related_field, ListField ):
                     new_rule = PULL
@@ -469,6 +624,72 @@ class RelationManagerMixin( object ):
                     # print(' ~~ REGISTERING delete rule `{0}` on `{3}.{4}` for relation `{1}.{2}`.'.format(
                     #     'PULL' if new_rule == 4 else 'DENY' if new_rule == 3 else 'NULLIFY', self._class_name, field_name, related_doc_type and related_doc_type._class_name, related_name).encode("utf-8") )
 
+    @classmethod
+    def list_relation_indexes( cls ):
+        '''
+        List the indexes required to efficiently query managed relations by the referencing field: for reverse
+        lookups, delete rules and consistency checks. Every stored field with a `related_name` gets an index;
+        `GenericReferenceField`s are indexed by the id of the referenced document.
+
+        @return: a list of index specifications, like `[ [ ( 'zoo', 1 ) ] ]`
+        @rtype: list
+        '''
+        indexes = []
+
+        for field_name, field in cls._fields.items():
+            if not getattr( field, 'related_name', None ) or getattr( field, 'storage', None ):
+                # Skip fields that aren't managed by us, or aren't stored in the document itself
+                continue
+
+            key = field.db_field
+            if isinstance( getattr( field, 'field', field ), GenericReferenceField ):
+                key += '._ref.$id'
+
+            if [ ( key, 1 ) ] not in indexes:
+                indexes.append( [ ( key, 1 ) ] )
+
+        return indexes
+
+    @classmethod
+    def ensure_relation_indexes( cls ):
+        '''
+        Ensure all indexes returned by `list_relation_indexes` exist, as well as the indexes on the
+        edge collections of relations with `storage='edges'`.
+        '''
+        background = cls._meta.get( 'index_background', False )
+        collection = cls._get_collection()
+        if collection.read_preference > 1:
+            return
+
+        for keys in cls.list_relation_indexes():
+            collection.ensure_index( keys, background=background )
+
+        for field in cls._fields.values():
+            if getattr( field, 'storage', None ) == 'edges':
+                edges = field.get_edge_collection()
+                edges.ensure_index( [ ( 'src', 1 ), ( 'dst', 1 ) ], unique=True, background=background )
+                edges.ensure_index( 'dst', background=background )
+
+    @classmethod
+    def compare_relation_indexes( cls ):
+        '''
+        Compare the indexes required for managed relations with the ones existing in the database.
+
+        @return: the missing indexes, like `{ 'missing': [ [ ( 'zoo', 1 ) ] ] }`
+        @rtype: dict
+        '''
+        existing = [ info[ 'key' ] for info in cls._get_collection().index_information().values() ]
+        return { 'missing': [ keys for keys in cls.list_relation_indexes() if keys not in existing ] }
+
+    @classmethod
+    def ensure_indexes( cls ):
+        '''
+        Override `ensure_indexes`, so indexes for managed relations are created along with the
+        document-defined indexes (unless `auto_create_index` is disabled in `meta`).
+        '''
+        super( RelationManagerMixin, cls ).ensure_indexes()
+        cls.ensure_relation_indexes()
+
     def _memoize_fields( self, updated_fields=None ):
         '''
         Creates a copy of the items in our fields so we can compare changes.
@@ -520,24 +741,65 @@ class RelationManagerMixin( object ):
         '''
         Override `save`. If a document is being saved for the first time,
         it will be given an id (if the save was successful).
+
+        Inside a `CacheScope` that coalesces writes, saving an existing document is validated right away,
+        but only queued: `pre_save`, the `on_change*` callbacks and the write itself happen when the scope commits.
         '''
-        request = request or ( kwargs and '_request' in kwargs and kwargs[ '_request' ] ) or self._request or None
+        request = self._get_request( request or ( kwargs and '_request' in kwargs and kwargs[ '_request' ] ) )
         self._set_request( request )
 
+        # A `CacheScope` can coalesce repeated saves of existing documents into a single write when it commits
+        scope = get_current_scope()
+        if scope is not None and scope.request is request and scope.defers_save( self ) and not force_insert:
+            # Validate now, so errors are raised here rather than when the scope commits
+            if validate:
+                self.validate( clean=clean )
+
+            scope.defer_save( self, dict( validate=validate, clean=clean, write_concern=write_concern,
+                cascade=cascade, cascade_kwargs=cascade_kwargs ) )
+            return self
+
+        # Change records for the outbox are written together with the document, in a transaction where possible
+        if self._meta.get( 'outbox' ) and not self._is_batched():
+            from .batch import WriteBatch
+
+            with WriteBatch( write_concern=write_concern ) as batch:
+                return batch.save( self, request, force_insert=force_insert, validate=validate, clean=clean, write_concern=write_concern,
+                    cascade=cascade, cascade_kwargs=cascade_kwargs, _refs=_refs, **kwargs )
+
         is_new = self.pk is None
+        version_field = self._meta.get( 'version_field' )
+        versioned = version_field and not is_new and not self._created and not force_insert
+
+        if version_field and not versioned and self._data.get( version_field ) is None:
+            self._data[ version_field ] = 1
 
         # Trigger `pre_save` hook if it's defined on this Document
         if hasattr( self, 'pre_save' ) and callable( self.pre_save ):
             self.pre_save( request )
 
+        # Determine changes to relations stored in edge collections before `_on_change` resets the memos
+        edge_changes = self._get_edge_changes()
+
         # Trigger `on_change*` callbacks for changed relations, so we can set new privileges
         if not is_new:
             # Remember changed fields for `post_save` before they get reset by `_on_change`.
             changed_fields = self.get_changed_fields()
+            # Remember our changes to hasmany relations as well, to re-apply them after a conflicting write
+            changes = self._get_hasmany_changes( changed_fields ) if versioned else {}
+            outbox_changes = self._get_outbox_changes( changed_fields )
             self._on_change( request, changed_fields=changed_fields )
 
-        result = super( RelationManagerMixin, self ).save( force_insert=force_insert, validate=validate, clean=clean,
-            write_concern=write_concern, cascade=cascade, cascade_kwargs=cascade_kwargs, _refs=_refs, kwargs=kwargs )
+        # Other processes may announce changes from here on, which our state can't reflect
+        written_at = time.time()
+
+        if versioned:
+            result = self._save_versioned( request, changes, validate=validate, clean=clean, write_concern=write_concern )
+        else:
+            result = super( RelationManagerMixin, self ).save( force_insert=force_insert, validate=validate, clean=clean,
+                write_concern=write_concern, cascade=cascade, cascade_kwargs=cascade_kwargs, _refs=_refs, kwargs=kwargs )
+
+        self._save_edges( edge_changes )
 
         # Update relations after saving if it's a new Document; it should have an id now
         if is_new:
@@ -553,14 +815,50 @@ class RelationManagerMixin( object ):
 
             # Remember changed fields for `post_save` before they get reset by `_on_change`.
             changed_fields = self.get_changed_fields()
+            outbox_changes = self._get_outbox_changes( changed_fields )
             self._on_change( request, changed_fields=changed_fields )
 
+        if outbox_changes:
+            record_changes( self, outbox_changes )
+
+        # Our changes have been saved; a weak cache doesn't need to keep us alive anymore
+        self._after_write( request.cache.release, self )
+        self._after_write( request.cache.share, self, written_at )
+        self._after_write( request.cache.publish, self )
+
         # Trigger `post_save` hook if it's defined on this Document
         if hasattr( self, 'post_save' ) and callable( self.post_save ):
             self.post_save( request, changed_fields )
 
         return result
 
+    def save_with_related( self, request=None, **kwargs ):
+        '''
+        Save this document together with the related documents that have changed because of changes to
+        its relations (and delete the ones that should be deleted; see `get_related_documents_to_update`).
+        The writes are sent to the database together, in a single transaction if possible (see `WriteBatch`).
+
+        @param request: the request or `CacheScope`; if not given, the active scope is used
+        @return: the documents that were saved and deleted
+        @rtype: tuple
+        '''
+        from .batch import WriteBatch
+
+        request = self._get_request( request )
+        to_save, to_delete = self.get_related_documents_to_update()
+
+        with WriteBatch() as batch:
+            for doc in to_save:
+                if doc is not self:
+                    batch.save( doc, request )
+
+            batch.save( self, request, **kwargs )
+
+            for doc in to_delete:
+                batch.delete( doc, request )
+
+        return to_save, to_delete
+
     def reload( self, max_depth=1 ):
         '''
         Override `reload`, to perform an `update_relations` after new data has been fetched.
@@ -569,16 +867,142 @@ class RelationManagerMixin( object ):
 
         # When doing an explicit reload, the relations as fetched from the database should be considered leading.
         self.update_relations() # TODO: add rebuild=True functionality?
+        self._cache.release( self )
 
         return result
 
-    def delete( self, request, **write_concern ):
+    @classmethod
+    def reload_many( cls, docs ):
+        '''
+        Reload `docs` (of any class) from the database, with a single query per collection. Unlike `reload`,
+        only fields whose stored value differs from ours are updated, and only relations that changed are
+        updated on the other side (for related documents in the cache). Relations that aren't stored in
+        the document itself aren't reloaded.
+
+        @type docs: Document[]
+        @return: the documents that have been reloaded; documents that no longer exist are left as they are
+        @rtype: Document[]
+        '''
+        docs_by_class = collections.OrderedDict()
+        for doc in docs:
+            if doc.pk:
+                docs_by_class.setdefault( doc.__class__, collections.OrderedDict() )[ doc.pk ] = doc
+
+        reloaded = []
+        related = collections.OrderedDict()
+
+        for document_type, docs_by_id in docs_by_class.items():
+            for son in document_type._get_collection().find( { '_id': { '$in': docs_by_id.keys() } } ):
+                doc = docs_by_id[ son[ '_id' ] ]
+                changes = doc._get_stored_changes( son )
+                reloaded.append( ( doc, changes ) )
+
+                # Both the previous and the new documents of changed hasone relations are needed to update them
+                for field_name, value in changes.items():
+                    if field_name in doc._memo_hasone:
+                        for ref in ( doc._data[ field_name ], value ):
+                            if isinstance( ref, dict ) and '_ref' in ref:
+                                key = ( doc._cache, get_document( ref[ '_cls' ] ) )
+                                ref = ref[ '_ref' ]
+                            else:
+                                key = ( doc._cache, doc._fields[ field_name ].document_type )
+
+                            if isinstance( ref, ( DBRef, Document ) ):
+                                related.setdefault( key, [] ).append( ref )
+
+        # Fetch the related documents that aren't cached yet, with a single query per collection
+        for ( cache, document_type ), refs in related.items():
+            cache.fetch( document_type, refs )
+
+        for doc, changes in reloaded:
+            doc._apply_stored_changes( changes )
+
+        return [ doc for doc, changes in reloaded ]
+
+    def _get_stored_changes( self, son ):
+        '''
+        Compare the stored state of this document with our data.
+
+        @type son: SON
+        @return: the stored value (as it would appear in `_data`) for every field that differs
+        @rtype: dict
+        '''
+        changes = {}
+
+        for field_name, field in self._fields.items():
+            if field_name == self._meta[ 'id_field' ] or field_name in self._external_fields:
+                continue
+
+            if field.db_field in son:
+                value = field.to_python( son[ field.db_field ] )
+            else:
+                value = field.default() if callable( field.default ) else field.default
+
+            current_value = self._data.get( field_name )
+
+            if field_name in self._memo_hasone:
+                changed = nequals( value, current_value )
+            elif field_name in self._memo_hasmany:
+                changed = [ get_id( doc ) for doc in value or [] ] != [ get_id( doc ) for doc in current_value or [] ]
+            else:
+                changed = value != current_value
+
+            if changed:
+                changes[ field_name ] = value
+
+        return changes
+
+    def _apply_stored_changes( self, changes ):
+        '''
+        Take over the stored values in `changes` (see `_get_stored_changes`), updating the other side of
+        changed relations, and consider the result unmodified.
+
+        @type changes: dict
+        '''
+        self._take_stored_values( changes )
+
+        self._memoize_fields()
+        self._changed_fields = []
+        self._created = False
+        self._cache._partial.pop( str( self.pk ), None )
+        self._cache.release( self )
+
+    def _take_stored_values( self, changes ):
+        '''
+        Set the stored values in `changes` (see `_get_stored_changes`), updating the other side of changed relations.
+
+        @type changes: dict
+        '''
+        for field_name, value in changes.items():
+            if field_name in self._memo_hasone:
+                ref = value[ '_ref' ] if isinstance( value, dict ) and '_ref' in value else value
+                related_doc = self._cache[ ref ] if ref else None
+
+                if ref and related_doc is None:
+                    # The related document doesn't exist (anymore); keep the reference
+                    self._data[ field_name ] = value
+                else:
+                    self.update_hasone( field_name, related_doc )
+
+            elif field_name in self._memo_hasmany:
+                previous_related_docs = self._data[ field_name ]
+                related_docs = [ self._cache.get( item[ '_ref' ] if isinstance( item, dict ) and '_ref' in item else item, item )
+                                    for item in value or [] ]
+
+                self._data[ field_name ] = BaseList( related_docs, self, field_name )
+                self.update_hasmany( field_name, related_docs, previous_related_docs )
+
+            else:
+                self._data[ field_name ] = value
+
+    def delete( self, request=None, **write_concern ):
         '''
         Override `delete` to clear existing relations before performing the actual delete, to prevent
         lingering references to this document when it's gone.
         @param safe:
         @return:
         '''
+        request = self._get_request( request )
         self._set_request( request )
 
         # Trigger `pre_delete` hook if it's defined on this Document
@@ -589,6 +1013,10 @@ class RelationManagerMixin( object ):
 
         result = super( RelationManagerMixin, self ).delete( write_concern=write_concern )
 
+        self._delete_edges()
+        request.cache.unshare( self )
+        self._after_write( request.cache.publish, self )
+
         # Trigger `post_delete` hook if it's defined on this Document
         if hasattr( self, 'post_delete' ) and callable( self.post_delete ):
             self.post_delete( request )
@@ -599,22 +1027,61 @@ class RelationManagerMixin( object ):
         '''
         Update the Document.
 
-        @param request:
-        @type request: pyramid.request.Request
+        @param request: the request or `CacheScope`; pass `None` to use the active scope
+        @type request: pyramid.request.Request or CacheScope
         @param args: (a tuple of) field names that should be updated
         @return:
         '''
+        request = self._get_request( request )
         self._set_request( request )
 
+        # Change records for the outbox are written together with the document, in a transaction where possible
+        if self._meta.get( 'outbox' ) and not self._is_batched():
+            from .batch import WriteBatch
+
+            with WriteBatch( write_concern=kwargs.get( 'write_concern' ) ) as batch:
+                return batch.update( self, request, *args, **kwargs )
+
         # Trigger `pre_update` hook if it's defined on this Document
         if hasattr( self, 'pre_update' ) and callable( self.pre_update ):
             self.pre_update( request )
 
+        # Relations that aren't stored in the document itself are written separately (if at all)
+        edge_changes = self._get_edge_changes( [ field_name for field_name in args if field_name in self._external_fields ] )
+
         # Add each `field_name` from args to kwargs, so it will be passed to the `update` call
         for field_name in args:
-            kwargs[ 'set__{}'.format( field_name ) ] = self[ field_name ]
+            if field_name not in self._external_fields:
+                kwargs[ 'set__{}'.format( field_name ) ] = self[ field_name ]
+
+        version_field = self._meta.get( 'version_field' )
+        outbox_changes = self._get_outbox_changes( args )
+
+        if version_field and kwargs:
+            db_field = self._fields[ version_field ].db_field
+            changes = self._get_hasmany_changes( args )
+
+            def write( expected, version ):
+                # Relations may have been merged with the stored document after a conflict
+                for field_name in changes:
+                    kwargs[ 'set__{}'.format( field_name ) ] = self[ field_name ]
+
+                return self._write_conditional( { db_field: expected }, request, changes,
+                    lambda: self._qs.filter( **self._object_key ).update_one( **dict( kwargs, **{ 'set__{}'.format( version_field ): version } ) ) )
+
+            self._write_versioned( request, changes, write, args )
+            result = 1
+        else:
+            result = super( RelationManagerMixin, self ).update( **kwargs ) if kwargs else None
+
+        self._save_edges( edge_changes )
+
+        if outbox_changes:
+            record_changes( self, outbox_changes )
 
-        result = super( RelationManagerMixin, self ).update( **kwargs )
+        # Shared copies of this document are out of date now
+        request.cache.unshare( self )
+        self._after_write( request.cache.publish, self )
 
         if args:
             self._on_change( request, changed_fields=args, updated_fields=args )
@@ -625,6 +1092,563 @@ class RelationManagerMixin( object ):
 
         return result
 
+    def _after_write( self, function, *args ):
+        '''
+        Call `function` once our writes have reached the database: right away, or when the `WriteBatch`
+        that records them has executed successfully.
+
+        @type function: callable
+        '''
+        if self._is_batched():
+            self._get_collection().defer( function, *args )
+        else:
+            function( *args )
+
+    def _is_batched( self ):
+        '''
+        Determine whether our writes are being recorded by a `WriteBatch`.
+
+        @rtype: bool
+        '''
+        # Check the class; pymongo collections turn any attribute into a sub-collection
+        return callable( getattr( type( self._get_collection() ), 'defer', None ) )
+
+    def _get_write_state( self ):
+        '''
+        Get the state that saving this document changes (its change tracking, memos and version), so it can be
+        restored with `_set_write_state` when the writes don't make it to the database after all.
+
+        @rtype: dict
+        '''
+        version_field = self._meta.get( 'version_field' )
+
+        return {
+            'changed_fields': list( getattr( self, '_changed_fields', [] ) ),
+            'created': self._created,
+            'memo_hasone': dict( self._memo_hasone ),
+            'memo_hasmany': dict( ( name, set( docs ) ) for name, docs in self._memo_hasmany.items() ),
+            'memo_simple': dict( self._memo_simple ),
+            'version': self._data.get( version_field ) if version_field else None
+        }
+
+    def _set_write_state( self, state ):
+        '''
+        Restore the state returned by `_get_write_state`.
+
+        @type state: dict
+        '''
+        version_field = self._meta.get( 'version_field' )
+
+        self._changed_fields = state[ 'changed_fields' ]
+        self._created = state[ 'created' ]
+        self._memo_hasone = state[ 'memo_hasone' ]
+        self._memo_hasmany = state[ 'memo_hasmany' ]
+        self._memo_simple = state[ 'memo_simple' ]
+
+        if version_field:
+            self._data[ version_field ] = state[ 'version' ]
+
+    def _save_versioned( self, request, changes, validate=True, clean=True, write_concern=None ):
+        '''
+        Save the changes to an existing document on the condition that its stored version hasn't changed
+        (see `_write_versioned`). The write itself is MongoEngine's `save`, with the version added to its
+        update spec. Cascading saves aren't supported for versioned documents.
+
+        @param changes: our changes to hasmany relations, as returned by `_get_hasmany_changes`
+        @type changes: dict
+        '''
+        version_field = self._meta[ 'version_field' ]
+        db_field = self._fields[ version_field ].db_field
+
+        def write( expected, version ):
+            self._data[ version_field ] = version
+            self._mark_as_changed( version_field )
+
+            if self._write_conditional( { db_field: expected }, request, changes,
+                    lambda: super( RelationManagerMixin, self ).save( validate=validate, clean=clean, write_concern=write_concern, cascade=False ) ):
+                return True
+
+            # Nothing has been written, and our changed fields are still marked as such
+            self._data[ version_field ] = expected
+            return False
+
+        self._write_versioned( request, changes, write )
+
+        # The memos for merged relations should reflect what has been stored now
+        if changes:
+            self._memoize_fields( changes )
+
+        return self
+
+    def _write_conditional( self, condition, request, changes, function ):
+        '''
+        Call `function` to write this document, with a collection swapped in that makes its update conditional
+        (see `_ConditionalCollection`). A collection that's swapped in already (by a `WriteBatch`) is kept;
+        when the batch finds that the update didn't match on execution, it's retried with `_retry_versioned`.
+
+        @param condition: the query the stored document should match
+        @type condition: dict
+        @param changes: our changes to hasmany relations, as returned by `_get_hasmany_changes`
+        @type changes: dict
+        @type function: callable
+        @return: whether the update matched a document (or has been recorded by a `WriteBatch`)
+        @rtype: bool
+        '''
+        previous = self.__dict__.get( '_get_collection' )
+        retry = lambda *args: self._retry_versioned( request, changes, *args )
+        collection = _ConditionalCollection( self._get_collection(), condition, retry )
+        self._get_collection = lambda: collection
+
+        try:
+            function()
+        except VersionConflictError:
+            return False
+        finally:
+            if previous is not None:
+                self._get_collection = previous
+            else:
+                del self._get_collection
+
+        return True
+
+    def _write_versioned( self, request, changes, write, field_names=() ):
+        '''
+        Perform `write` on the condition that the stored version of this document is the one we have.
+        After a conflict, the stored document is merged into this one (see `_merge_stored`), and the write is
+        retried, up to `meta['version_retries']` times. If it defines `on_version_conflict`, that's called
+        after each merge with the request, the stored document (as SON) and `changes`; it can return `False`
+        to give up.
+
+        @param changes: our changes to hasmany relations, as returned by `_get_hasmany_changes`
+        @type changes: dict
+        @param write: performs the write when called with the expected and the new version;
+            returns whether it succeeded
+        @type write: callable
+        @param field_names: the fields that `write` writes, apart from the ones marked as changed
+        @type field_names: list<string> or tuple<string>
+        @return: the number of conflicts that were resolved
+        @rtype: int
+        '''
+        version_field = self._meta[ 'version_field' ]
+        retries = self._meta.get( 'version_retries', DEFAULT_VERSION_RETRIES )
+
+        for attempt in range( retries + 1 ):
+            expected = self._data.get( version_field )
+            version = ( expected or 0 ) + 1
+
+            if write( expected, version ):
+                self._data[ version_field ] = version
+                self._memo_simple[ version_field ] = version
+                return attempt
+
+            son = self._get_collection().find_one( { '_id': self.pk } )
+            if son is None:
+                raise VersionConflictError( '{} `{}` has been deleted'.format( self._class_name, self.pk ) )
+
+            self._merge_stored( son, changes, field_names )
+
+            if hasattr( self, 'on_version_conflict' ) and callable( self.on_version_conflict ):
+                if self.on_version_conflict( request, son, changes ) is False:
+                    break
+
+        raise VersionConflictError( "Can't write {} `{}`; it has been changed by others".format( self._class_name, self.pk ) )
+
+    def _retry_versioned( self, request, changes, collection, spec, document, session=None ):
+        '''
+        Retry a versioned update that a `WriteBatch` recorded, but that didn't match the stored document when
+        the batch executed. Like `_write_versioned`, the stored document is merged into this one, and the
+        fields that `document` writes are written again with our (merged) values, up to `meta['version_retries']`
+        times. This happens while the batch executes, in its transaction (if any).
+
+        @param collection: the pymongo collection
+        @param spec: the spec of the recorded update
+        @type spec: dict
+        @param document: the recorded update
+        @type document: dict
+        @param session: the session of the batch's transaction (if any)
+        '''
+        version_field = self._meta[ 'version_field' ]
+        db_field = self._fields[ version_field ].db_field
+        retries = self._meta.get( 'version_retries', DEFAULT_VERSION_RETRIES )
+        kwargs = { 'session': session } if session is not None else {}
+
+        db_fields = set( key.split( '.' )[ 0 ] for keys in document.values() for key in keys ) - set( [ db_field, '_id' ] )
+        field_names = [ field_name for field_name, field in self._fields.items() if field.db_field in db_fields ]
+
+        for attempt in range( retries ):
+            son = collection.find_one( { '_id': self.pk }, **kwargs )
+            if son is None:
+                raise VersionConflictError( '{} `{}` has been deleted'.format( self._class_name, self.pk ) )
+
+            self._merge_stored( son, changes, field_names )
+
+            if hasattr( self, 'on_version_conflict' ) and callable( self.on_version_conflict ):
+                if self.on_version_conflict( request, son, changes ) is False:
+                    break
+
+            expected = self._data.get( version_field )
+            version = ( expected or 0 ) + 1
+
+            values = self.to_mongo()
+            update = { '$set': { db_field: version } }
+            for key in db_fields:
+                if values.get( key ) is not None:
+                    update[ '$set' ][ key ] = values[ key ]
+                else:
+                    update.setdefault( '$unset', {} )[ key ] = 1
+
+            query = dict( spec, **{ db_field: expected } )
+
+            # Check the class; pymongo 2 collections turn any attribute into a sub-collection
+            if callable( getattr( type( collection ), 'update_one', None ) ):
+                result = collection.update_one( query, update, **kwargs )
+                matched = not result.acknowledged or result.matched_count
+            else:
+                last_error = collection.update( query, update )
+                matched = last_error is None or last_error.get( 'n' )
+
+            if matched:
+                self._data[ version_field ] = version
+                self._memo_simple[ version_field ] = version
+                self._clear_changed_fields()
+                if changes:
+                    self._memoize_fields( changes )
+                return attempt + 1
+
+        raise VersionConflictError( "Can't write {} `{}`; it has been changed by others".format( self._class_name, self.pk ) )
+
+    def _get_hasmany_changes( self, field_names ):
+        '''
+        Get the added and removed references for the hasmany relations in `field_names`, compared to their memos.
+
+        @type field_names: list<string> or set<string>
+        @return: a tuple of added and removed documents (or references) per field name
+        @rtype: dict
+        '''
+        changes = {}
+
+        for field_name in field_names:
+            if field_name in self._memo_hasmany and field_name not in self._external_fields:
+                previous_related_docs = self._memo_hasmany[ field_name ]
+                current_related_docs = self._data[ field_name ]
+                changes[ field_name ] = relation_diff( current_related_docs, previous_related_docs )
+
+        return changes
+
+    def _get_outbox_changes( self, field_names ):
+        '''
+        Get the added and removed ids for the relations in `field_names` that should be recorded in the outbox,
+        as configured by `meta['outbox']`: `True` for all relations, or a list of field names.
+
+        @type field_names: list<string> or set<string>
+        @return: a tuple of added and removed ids per field name
+        @rtype: dict
+        '''
+        outbox = self._meta.get( 'outbox' )
+        changes = {}
+
+        if not outbox:
+            return changes
+
+        for field_name in field_names:
+            if outbox is not True and field_name not in outbox:
+                continue
+
+            if field_name in self._memo_hasone:
+                previous_related_doc, related_doc = self._memo_hasone[ field_name ], self._data[ field_name ]
+                if nequals( related_doc, previous_related_doc ):
+                    added, removed = [ related_doc ], [ previous_related_doc ]
+                else:
+                    continue
+            elif field_name in self._memo_hasmany:
+                previous_related_docs, related_docs = self._memo_hasmany[ field_name ], self._data[ field_name ]
+                added, removed = relation_diff( related_docs, previous_related_docs )
+            else:
+                continue
+
+            added = [ get_id( doc ) for doc in added if doc and get_id( doc ) ]
+            removed = [ get_id( doc ) for doc in removed if doc and get_id( doc ) ]
+            if added or removed:
+                changes[ field_name ] = ( added, removed )
+
+        return changes
+
+    def _merge_stored( self, son, changes, field_names=() ):
+        '''
+        Merge the stored state of this document into it after a conflicting write. We take over its version,
+        and re-apply `changes` to its hasmany relations. The memos for those relations are set to the stored
+        references, so `on_change*` callbacks only see our changes. Fields we've changed (or are writing,
+        as listed in `field_names`) keep our value; the others take over their stored value.
+
+        @param son: the stored document
+        @type son: SON
+        @param changes: our changes to hasmany relations, as returned by `_get_hasmany_changes`
+        @type changes: dict
+        @type field_names: list<string> or tuple<string>
+        '''
+        version_field = self._meta[ 'version_field' ]
+        self._data[ version_field ] = son.get( self._fields[ version_field ].db_field )
+
+        changed_db_fields = set( key.split( '.' )[ 0 ] for key in self._get_changed_fields() )
+        stored_changes = dict( ( field_name, value ) for field_name, value in self._get_stored_changes( son ).items()
+            if field_name != version_field and field_name not in changes and field_name not in field_names and
+                self._fields[ field_name ].db_field not in changed_db_fields )
+
+        if stored_changes:
+            self._take_stored_values( stored_changes )
+            self._memoize_fields( stored_changes.keys() )
+
+        for field_name, ( added_docs, removed_docs ) in changes.items():
+            field = self._fields[ field_name ]
+            collection = field.field.document_type._get_collection_name()
+
+            stored_docs = []
+            for value in son.get( field.db_field ) or []:
+                ref = value if isinstance( value, DBRef ) else DBRef( collection, value )
+                stored_docs.append( self._cache.get( ref, ref ) )
+
+            removed_ids = set( get_id( doc ) for doc in removed_docs )
+            value = [ doc for doc in stored_docs if get_id( doc ) not in removed_ids ]
+
+            # Keep the order of added documents as we have it
+            stored_ids = set( get_id( doc ) for doc in stored_docs )
+            added_ids = set( get_id( doc ) for doc in added_docs )
+            value += [ doc for doc in self._data[ field_name ] if get_id( doc ) in added_ids and get_id( doc ) not in stored_ids ]
+
+            self._data[ field_name ] = BaseList( value, self, field_name )
+            self._mark_as_changed( field_name )
+            self._memo_hasmany[ field_name ] = set( stored_docs )
+
+    def aload( self, *field_names ):
+        '''
+        Asynchronous version of `load_relations`, for the relations in `field_names` (or all relations).
+        The returned future can be awaited from asyncio code.
+
+        Asynchronous operations run on another thread, where they change the cache and the documents in it.
+        They require a `ThreadSafeDocumentCache`, and this document and its related documents shouldn't be
+        used until the future is done.
+
+        @rtype: AwaitableFuture
+        '''
+        self._check_thread_safe( self._cache )
+        return submit( self.load_relations, list( field_names ) or None )
+
+    def asave( self, request=None, **kwargs ):
+        '''
+        Asynchronous version of `save`; see `aload`. The request (or active `CacheScope`) is determined
+        right away, since the save itself runs on another thread.
+
+        @rtype: AwaitableFuture
+        '''
+        request = self._get_request( request )
+        self._check_thread_safe( getattr( request, 'cache', None ) )
+        return submit( self.save, request, **kwargs )
+
+    def adelete( self, request=None, **write_concern ):
+        '''
+        Asynchronous version of `delete`; see `aload`.
+
+        @rtype: AwaitableFuture
+        '''
+        request = self._get_request( request )
+        self._check_thread_safe( getattr( request, 'cache', None ) )
+        return submit( self.delete, request, **write_concern )
+
+    def _check_thread_safe( self, cache ):
+        if not isinstance( cache, ThreadSafeDocumentCache ):
+            raise RelationalError( 'Asynchronous operations on {} require a `ThreadSafeDocumentCache`; got `{}`'.format( self._class_name, cache ) )
+
+    def to_mongo( self ):
+        '''
+        Override `to_mongo`, to leave out relations that aren't stored in the document itself.
+        '''
+        data = super( RelationManagerMixin, self ).to_mongo()
+
+        for field_name in self._external_fields:
+            data.pop( self._fields[ field_name ].db_field, None )
+
+        return data
+
+    def _get_changed_fields( self, inspected=None ):
+        '''
+        Override `_get_changed_fields`, so relations that aren't stored in the document itself are never `$set` on it.
+        '''
+        changed_fields = super( RelationManagerMixin, self )._get_changed_fields( inspected )
+        external_db_fields = [ self._fields[ field_name ].db_field for field_name in self._external_fields ]
+
+        return [ key for key in changed_fields if key.split( '.' )[ 0 ] not in external_db_fields ]
+
+    def _clear_changed_fields( self ):
+        '''
+        Override `_clear_changed_fields`. Mongoengine also clears the changed fields of documents that are
+        merely referenced by a changed field (dereferencing them on the way), which drops their pending changes.
+        '''
+        for changed in self._get_changed_fields():
+            data = self
+
+            for part in changed.split( '.' ):
+                if isinstance( data, list ):
+                    try:
+                        data = data[ int( part ) ]
+                    except ( IndexError, ValueError ):
+                        data = None
+                elif isinstance( data, dict ):
+                    data = data.get( part, None )
+                elif isinstance( data, base.BaseDocument ):
+                    data = data._data.get( data._reverse_db_field_map.get( part, part ), None )
+                else:
+                    data = getattr( data, part, None )
+
+                # Only embedded documents are cleared along with us
+                if isinstance( data, Document ):
+                    break
+
+                if hasattr( data, '_changed_fields' ):
+                    data._changed_fields = []
+
+        self._changed_fields = []
+
+    def _mark_as_changed( self, key ):
+        '''
+        Override `_mark_as_changed`, so a weak cache holds on to us while we have pending changes.
+        '''
+        super( RelationManagerMixin, self )._mark_as_changed( key )
+
+        if hasattr( self, '_cache' ) and self.pk:
+            self._cache.retain( self )
+
+    def _has_stored_external( self, field_name ):
+        '''
+        Determine whether a relation that isn't stored in the document itself still has to be read from the database.
+        New documents don't have any stored relations.
+        '''
+        return field_name not in self._loaded_external and not self._created and bool( self.pk )
+
+    def _find_external_ids( self, field_name, offset=0, limit=0 ):
+        '''
+        Query the ids of the documents in a relation that isn't stored in the document itself; for edges in
+        the order they were added, for reverse relations in the order the related documents were created.
+
+        @type field_name: string
+        @param offset: the number of ids to skip
+        @param limit: the maximum number of ids to return; 0 means no limit
+        @rtype: generator
+        '''
+        field = self._fields[ field_name ]
+
+        if field.storage == 'edges':
+            cursor = field.get_edge_collection().find( { 'src': self.pk }, { 'dst': 1 } )
+            key = 'dst'
+        else:
+            related_doc_type = field.field.document_type
+            related_field = related_doc_type._fields[ field.related_name ]
+
+            collection = related_doc_type._get_collection()
+            cursor = collection.find( { related_field.db_field: related_field.to_mongo( self ) }, { '_id': 1 } )
+            key = '_id'
+
+        return ( row[ key ] for row in cursor.sort( '_id', 1 ).skip( offset ).limit( limit ) )
+
+    def _load_external( self, field_name ):
+        '''
+        Load the references for a relation that isn't stored in the document itself, if that hasn't happened yet.
+        The memo for the relation is synced with the loaded references.
+
+        @type field_name: string
+        '''
+        is_stored = self._has_stored_external( field_name )
+        self._loaded_external.add( field_name )
+
+        if not is_stored:
+            return
+
+        field = self._fields[ field_name ]
+        refs = field.to_python( list( self._find_external_ids( field_name ) ) )
+
+        self._data[ field_name ] = BaseList( refs, self, field_name )
+        self._memoize_fields( [ field_name ] )
+
+    def _get_edge_changes( self, field_names=None ):
+        '''
+        Get the ids of added and removed documents for relations stored in an edge collection,
+        compared to their memos.
+
+        @param field_names: limit the relations that are checked. If not specified, all edge relations are checked.
+        @type field_names: list<string> or set<string>
+        @return: a tuple of ( added ids, removed ids ) per field name
+        @rtype: dict
+        '''
+        changes = {}
+
+        for field_name in ( field_names if field_names is not None else self._external_fields ):
+            # Relations that haven't been loaded can't have been changed
+            if self._external_fields[ field_name ] != 'edges' or self._has_stored_external( field_name ):
+                continue
+
+            current_related_docs = self._data[ field_name ]
+            previous_related_docs = set() if self._created else self._memo_hasmany[ field_name ]
+
+            added_docs, removed_docs = relation_diff( current_related_docs, previous_related_docs )
+
+            # An edge needs the id of the related document; one that hasn't been saved can't have been stored either
+            if any( not get_id( doc ) for doc in added_docs ):
+                raise RelationalError( "Can't store `{}` of {}: related documents should be saved first".format( field_name, self ) )
+
+            changes[ field_name ] = ( [ get_id( doc ) for doc in added_docs ], [ get_id( doc ) for doc in removed_docs if get_id( doc ) ] )
+
+        return changes
+
+    def _save_edges( self, edge_changes ):
+        '''
+        Write changes (as returned by `_get_edge_changes`) to the edge collections.
+
+        @type edge_changes: dict
+        '''
+        for field_name, ( added_ids, removed_ids ) in edge_changes.items():
+            collection = self._fields[ field_name ].get_edge_collection()
+
+            if removed_ids:
+                collection.remove( { 'src': self.pk, 'dst': { '$in': removed_ids } } )
+
+            if added_ids:
+                collection.insert( [ { 'src': self.pk, 'dst': object_id } for object_id in added_ids ] )
+
+            # The references in `_data` now reflect the stored edges
+            self._loaded_external.add( field_name )
+
+    def _delete_edges( self ):
+        '''
+        Remove all edges from and to this document.
+        '''
+        for field_name, storage in self._external_fields.items():
+            if storage == 'edges':
+                self._fields[ field_name ].get_edge_collection().remove( { 'src': self.pk } )
+
+        # Remove this document from edge relations on the other side
+        for field_name in self._memo_hasone:
+            related_field = self._get_related_field( field_name )
+
+            if getattr( related_field, 'storage', None ) == 'edges':
+                related_field.get_edge_collection().remove( { 'dst': self.pk } )
+
+    def _get_related_field( self, field_name ):
+        '''
+        Get the field on the other side of a managed relation, if it can be determined.
+
+        @type field_name: string
+        @rtype: BaseField or None
+        '''
+        field = self._fields[ field_name ]
+        related_name = getattr( field, 'related_name', None )
+
+        if isinstance( field, ListField ):
+            field = field.field
+
+        related_doc_type = getattr( field, 'document_type', None )
+
+        if related_name and related_doc_type:
+            return related_doc_type._fields.get( related_name )
+
     def clear_relations( self ):
         '''
         Clear relations from this document (both hasOne and hasMany)
@@ -639,7 +1663,8 @@ class RelationManagerMixin( object ):
 
     def _on_change( self, request, changed_fields=None, updated_fields=None ):
         '''
-        Handle Document changes. Triggers `on_change*` callbacks to handle changes on specific relations.
+        Handle Document changes. Triggers `on_change*` callbacks to handle changes on specific relations,
+        or queues them when the active `CacheScope` defers them (see `CacheScope.defer_hooks`).
 
         @param changed_fields: The set of `changed_fields` to process.
             If not set, will be determined by calling `get_changed_fields`.
@@ -650,6 +1675,22 @@ class RelationManagerMixin( object ):
         fields = set( changed_fields ) if changed_fields is not None else self.get_changed_fields()
         updated_fields = set( updated_fields ) if updated_fields is not None else set()
 
+        # A `CacheScope` can defer callbacks, to call them once with the net changes when it's flushed
+        scope = get_current_scope()
+        if scope is not None and scope.defer_hooks and scope.request is request:
+            changes = {}
+            for name in fields:
+                if updated_fields and name not in updated_fields:
+                    continue
+
+                if callable( getattr( self, 'on_change_{}'.format( name ), None ) ) and \
+                        ( name in self._memo_hasone or name in self._memo_hasmany or name in self._memo_simple ):
+                    changes[ name ] = self.get_changes_for_field( name )
+
+            scope.defer_changes( self, fields, changes, updated_fields )
+            self._memoize_fields( updated_fields )
+            return
+
         # The main `on_change` function should always be called, regardless of `updated_fields`!
         if hasattr( self, 'on_change' ) and callable( self.on_change ):
             self.on_change( request=request, changed_fields=fields, updated_fields=updated_fields )
@@ -688,12 +1729,11 @@ class RelationManagerMixin( object ):
                 changed_fields.add( field_name )
 
         # For hasmany, check if different values exist in the old set compared
-        # to the new set (using symmetric_difference).
+        # to the new set (in either direction).
         for field_name, previous_related_docs in self._memo_hasmany.iteritems():
-            current_related_docs = set( self._data[ field_name ] )
+            added_docs, removed_docs = relation_diff( self._data[ field_name ], previous_related_docs )
 
-            if len( set_difference( previous_related_docs, current_related_docs ) ) > 0 or \
-                    len( set_difference( current_related_docs, previous_related_docs ) ) > 0:
+            if added_docs or removed_docs:
                 changed_fields.add( field_name )
 
         for field_name, previous_value in self._memo_simple.iteritems():
@@ -729,8 +1769,7 @@ class RelationManagerMixin( object ):
 
         elif field_name in self._memo_hasmany:
             prev_value = self._memo_hasmany[ field_name ]
-            added_docs = set_difference( curr_value, prev_value )
-            removed_docs = set_difference( prev_value, curr_value )
+            added_docs, removed_docs = relation_diff( curr_value, prev_value )
 
         else:
             raise RelationalError( "Can't find _memo entry for field_name={}".format( field_name ) )
@@ -771,11 +1810,23 @@ class RelationManagerMixin( object ):
         changed_fields = self.get_changed_fields()
         for name in changed_fields:
             if hasattr( self._fields[ name ], 'related_name' ):
+                related_storage = getattr( self._get_related_field( name ), 'storage', None )
+
+                # Relations with `storage='reverse'` are derived from this side; there's nothing to write on the other side
+                if related_storage == 'reverse':
+                    continue
+
                 # This field is `managed`. Find out the changes.
                 added, removed = self.get_changes_for_field( name )
-                removed_relations[ name ] = removed if isinstance( removed, set ) else { removed }
+                removed = removed if isinstance( removed, set ) else { removed }
                 to_save.update( added if isinstance( added, set ) else { added } )
 
+                # Documents that store the relation in an edge collection need to save their removed edges
+                if related_storage == 'edges':
+                    to_save.update( removed )
+                else:
+                    removed_relations[ name ] = removed
+
         # What should happen to removed relations depends on the delete rule 
         # they registered with us, which in MongoEngine currently is one of:
         #
@@ -862,10 +1913,15 @@ class RelationManagerMixin( object ):
 
                     if isinstance( related_data, ( list, tuple ) ):
                         if self in related_data:
-                            related_data.remove( self )
+                            # Relations derived from this side (`storage='reverse'`) are read-only, so bypass `BaseList`
+                            if related_doc._external_fields.get( field.related_name ) == 'reverse':
+                                list.remove( related_data, self )
+                            else:
+                                related_data.remove( self )
                             # print( 'Removed `{0}` from `{1}` of {2} `{3}`'.format( self, field.related_name, related_doc._class_name, related_doc ).encode("utf-8") )
                     elif related_data == self:
                         related_doc._data[ field.related_name ] = None
+                        related_doc._retain_changed_relation( field.related_name )
                         # print( 'Cleared `{0}` of {1}'.format( field.related_name, related_doc ).encode("utf-8") )
 
                 # Set new value
@@ -876,13 +1932,28 @@ class RelationManagerMixin( object ):
 
                     if isinstance( related_data, ( list, tuple ) ):
                         if self not in related_data:
-                            related_data.append( self )
+                            if related_doc._external_fields.get( field.related_name ) == 'reverse':
+                                list.append( related_data, self )
+                            else:
+                                related_data.append( self )
                             # print( 'Appended `{0}` to `{1}` of {2} `{3}`'.format( self, field.related_name, related_doc._class_name, related_doc ).encode("utf-8") )
                     elif related_data != self:
                         related_doc._data[ field.related_name ] = self
+                        related_doc._retain_changed_relation( field.related_name )
                         # print( 'Set `{0}` of `{1}` to `{2}`'.format( field.related_name, related_doc, self ).encode("utf-8") )
 
             self._data[ field_name ] = new_value
+            self._retain_changed_relation( field_name )
+
+    def _retain_changed_relation( self, field_name ):
+        '''
+        Let a weak cache hold on to us if the hasOne relation `field_name` differs from its memo. Relations
+        are updated from the other side without `_mark_as_changed`, so this is the only pending change we'd know of.
+
+        @type field_name: string
+        '''
+        if self.pk and field_name in self._memo_hasone and nequals( self._data[ field_name ], self._memo_hasone[ field_name ] ):
+            self._cache.retain( self )
 
     def update_hasmany( self, field_name, current_related_docs, previous_related_docs=None ):
         '''
@@ -906,8 +1977,7 @@ class RelationManagerMixin( object ):
 
             # Only process fields that have a related_name set.
             if hasattr( field, 'related_name' ):
-                added_docs = set_difference( current_related_docs, previous_related_docs )
-                removed_docs = set_difference( previous_related_docs, current_related_docs )
+                added_docs, removed_docs = relation_diff( current_related_docs, previous_related_docs )
 
                 # print( 'update_hasmany on `{}`: current_related_docs=`{}`, previous_related_docs=`{}`, added_docs=`{}`, removed_docs=`{}'.format( self, current_related_docs, previous_related_docs, added_docs, removed_docs ) )
 
@@ -985,6 +2055,11 @@ class RelationManagerMixin( object ):
 
         if isinstance( data, DBRef ):
             result = self._cache[ data ]
+
+            # Upgrade partially loaded documents if this relation requires more fields
+            if isinstance( result, Document ) and self._cache.is_partial( result, self._get_projection( field_name ) ):
+                self._cache.upgrade( [ result ] )
+
             if isinstance( result, Document ):
                 self._data[ field_name ] = result
         elif isinstance( data, list ) and hasattr( field, 'field' ):
@@ -995,17 +2070,276 @@ class RelationManagerMixin( object ):
 
         return result
 
+    def _get_projection( self, field_name, only=None ):
+        '''
+        Get the names of the fields that should be loaded when dereferencing the relation `field_name`.
+        The `related_name` is always included, so relations can still be maintained on partial documents.
+
+        @param only: field names that override the projection set on the field itself
+        @type only: list<string> or set<string>
+        @return: a set of field names, or None if documents should be loaded completely
+        @rtype: set<string> or None
+        '''
+        field = self._fields[ field_name ]
+        only = only or getattr( field, 'only', None )
+
+        if not only:
+            return None
+
+        only = set( only )
+        if hasattr( field, 'related_name' ):
+            only.add( field.related_name )
+
+        return only
+
+    def load_relations( self, fields=None, related_fields=None, parallel=False ):
+        '''
+        Dereference relations, using a single query per relation for any documents that
+        aren't cached yet.
+
+        @param fields: the names of the relations to load. If not specified, all relations are loaded.
+        @type fields: list<string> or set<string>
+        @param related_fields: a projection per relation, overriding the field's `only`;
+            for example `{ 'animals': [ 'name', 'species' ] }`.
+        @type related_fields: dict
+        @param parallel: combine the queries for relations to the same document type, and run the queries
+            for different document types at the same time (on a bounded number of threads). Only the queries
+            run on other threads, so this works with any cache.
+        @type parallel: bool
+        @return: the loaded document (for hasOne relations) or documents (for hasMany relations), per field name
+        @rtype: dict
+        '''
+        related_fields = related_fields or {}
+        fields = fields if fields is not None else set( related_fields ) or set( self._memo_hasone ) | set( self._memo_hasmany )
+        result = {}
+
+        if parallel:
+            self._prefetch_relations( fields, related_fields )
+
+        for field_name in fields:
+            field = self._fields[ field_name ]
+            only = self._get_projection( field_name, related_fields.get( field_name ) )
+
+            if field_name in self._memo_hasone:
+                data = self._data[ field_name ]
+                if isinstance( data, dict ) and '_ref' in data:
+                    data = data[ '_ref' ]
+
+                if isinstance( field, ReferenceField ) and isinstance( data, ( DBRef, Document ) ):
+                    docs = self._cache.fetch( field.document_type, [ data ], only=only )
+                    if docs:
+                        self._data[ field_name ] = docs[ 0 ]
+
+                result[ field_name ] = self[ field_name ]
+
+            elif field_name in self._memo_hasmany:
+                value = self._data[ field_name ]
+
+                if isinstance( field.field, ReferenceField ) and value:
+                    self._cache.fetch( field.field.document_type, value, only=only )
+
+                    if all( self._cache[ doc ] for doc in value ):
+                        value = BaseList( [ self._cache[ doc ] for doc in value ], self, field_name )
+                        value._dereferenced = True
+                        self._data[ field_name ] = value
+
+                result[ field_name ] = self[ field_name ]
+
+            else:
+                raise RelationalError( "`{}` is not a relation of {}".format( field_name, self._class_name ) )
+
+        return result
+
+    def _prefetch_relations( self, fields, related_fields ):
+        '''
+        Fetch the uncached documents for the ReferenceField relations in `fields`, with a single query
+        per document type. Queries for different document types run at the same time; the documents are
+        added to the cache on this thread (see `DocumentCache.fetch_many`).
+        '''
+        batches = {}
+
+        for field_name in fields:
+            field = self._fields.get( field_name )
+
+            if field_name in self._memo_hasone and isinstance( field, ReferenceField ):
+                document_type = field.document_type
+                refs = [ self._data[ field_name ] ]
+                if not isinstance( refs[ 0 ], ( DBRef, Document ) ):
+                    continue
+            elif field_name in self._memo_hasmany and isinstance( field.field, ReferenceField ):
+                document_type = field.field.document_type
+                refs = self._data[ field_name ]
+                if not refs:
+                    continue
+            else:
+                continue
+
+            only = self._get_projection( field_name, related_fields.get( field_name ) )
+
+            if document_type in batches:
+                batch_refs, batch_only = batches[ document_type ]
+                batches[ document_type ] = ( batch_refs + list( refs ), batch_only | only if batch_only and only else None )
+            else:
+                batches[ document_type ] = ( list( refs ), only )
+
+        self._cache.fetch_many( [ ( document_type, refs, only ) for document_type, ( refs, only ) in batches.items() ], parallel=True )
+
+    def related_page( self, field_name, offset, limit, only=None ):
+        '''
+        Get a window of the documents in a hasMany relation, without loading or dereferencing the full list.
+        Only the requested slice of references is retrieved from the database (using a `$slice` projection),
+        and only those references are dereferenced (through the cache).
+
+        When the relation has unsaved changes (or this document hasn't been saved), the window is taken from
+        the current list instead.
+
+        @param field_name: the name of a hasMany relation
+        @type field_name: string
+        @param offset: the index of the first document in the window; counted from the start of the relation
+        @type offset: int
+        @param limit: the maximum number of documents in the window; should be positive
+        @type limit: int
+        @param only: the names of the fields to load on the related documents; overrides the field's `only`
+        @type only: list<string> or set<string>
+        @rtype: Document[]
+        '''
+        if field_name not in self._memo_hasmany:
+            raise RelationalError( "`{}` is not a hasMany relation of {}".format( field_name, self._class_name ) )
+
+        # `$slice` counts negative offsets from the end, and slicing the current list would count them differently
+        if offset < 0:
+            raise ValueError( 'offset={} should not be negative'.format( offset ) )
+
+        # `$slice` needs a positive count as well
+        if limit <= 0:
+            raise ValueError( 'limit={} should be positive'.format( limit ) )
+
+        field = self._fields[ field_name ]
+        refs = None
+
+        if field_name in self._external_fields:
+            # Query the requested window, unless the relation has been loaded (and possibly changed) already
+            if self._has_stored_external( field_name ):
+                refs = field.to_python( list( self._find_external_ids( field_name, offset, limit ) ) )
+
+        elif self.pk and field.db_field not in getattr( self, '_changed_fields', [] ):
+            # Exclude all other fields, so we only transfer the requested window of references
+            projection = dict( ( f.db_field, 0 ) for f in self._fields.values() if f.db_field not in ( '_id', field.db_field ) )
+            projection[ field.db_field ] = { '$slice': [ offset, limit ] }
+
+            son = self._get_collection().find_one( { '_id': self.pk }, projection )
+            if son is not None:
+                refs = field.to_python( son.get( field.db_field ) or [] )
+
+        if refs is None:
+            refs = list( self._data[ field_name ] )[ offset: offset + limit ]
+
+        if isinstance( field.field, ReferenceField ):
+            return self._cache.fetch( field.field.document_type, refs, only=self._get_projection( field_name, only ) )
+
+        return self._cache.add( _import_class( 'DeReference' )()( refs, max_depth=1 ) )
+
+    def iter_related( self, field_name, chunk_size=500, only=None ):
+        '''
+        Iterate over the documents in a hasMany relation, fetching them `chunk_size` at a time with an `$in` query
+        over the references. The relation itself doesn't get dereferenced, and fetched documents aren't added to the
+        cache, so memory use doesn't grow with the size of the relation. Documents that are already cached are
+        yielded from the cache.
+
+        @param field_name: the name of a hasMany relation
+        @type field_name: string
+        @param chunk_size: the number of documents to fetch per query
+        @type chunk_size: int
+        @param only: the names of the fields to load on the related documents; overrides the field's `only`
+        @type only: list<string> or set<string>
+        @rtype: generator
+        '''
+        if field_name not in self._memo_hasmany:
+            raise RelationalError( "`{}` is not a hasMany relation of {}".format( field_name, self._class_name ) )
+
+        field = self._fields[ field_name ]
+        only = self._get_projection( field_name, only )
+
+        if field_name in self._external_fields and self._has_stored_external( field_name ):
+            # Stream references straight from the database
+            refs = ( field.field.to_python( object_id ) for object_id in self._find_external_ids( field_name ) )
+        else:
+            refs = iter( list( self._data[ field_name ] ) )
+
+        while True:
+            chunk = list( itertools.islice( refs, chunk_size ) )
+            if not chunk:
+                break
+
+            if not isinstance( field.field, ReferenceField ):
+                for doc in _import_class( 'DeReference' )()( chunk, max_depth=1 ):
+                    if isinstance( doc, Document ):
+                        yield self._cache[ doc ] if doc in self._cache else doc
+                continue
+
+            docs = {}
+            missing_ids = []
+            for ref in chunk:
+                if isinstance( ref, Document ):
+                    continue
+
+                object_id = ref.id if isinstance( ref, DBRef ) else ref
+                doc = self._cache[ object_id ]
+                if doc is not None and not self._cache.is_partial( doc, only ):
+                    docs[ object_id ] = doc
+                else:
+                    missing_ids.append( object_id )
+
+            if missing_ids:
+                # Fetched documents aren't added to any cache, not even the active `CacheScope`'s
+                queryset = field.field.document_type.objects
+                if hasattr( queryset, 'with_cache' ):
+                    queryset = queryset.with_cache( None )
+                docs.update( ( queryset.only( *only ) if only else queryset ).in_bulk( missing_ids ) )
+
+            for ref in chunk:
+                doc = ref if isinstance( ref, Document ) else docs.get( ref.id if isinstance( ref, DBRef ) else ref )
+                if doc is not None:
+                    yield doc
+
+    def _get_request( self, request=None ):
+        '''
+        Determine the request (or other unit of work) to use: `request` if given, or the one we've been
+        used with before, or the one of the active `CacheScope`.
+        '''
+        return request or getattr( self, '_request', None ) or get_current_request()
+
     def _set_request( self, request, update_relations=True ):
-        if not isinstance( request, Request ):
-            raise ValueError( 'request={} should be an instance of `pyramid.request.Request`'.format( request ) )
+        if request is None:
+            raise ValueError( 'request={} should be a `CacheScope` or a request (like `pyramid.request.Request`); '
+                              'pass one explicitly, or use an active `CacheScope`'.format( request ) )
         elif not hasattr( self, '_request' ):
+            # Any object can serve as unit of work, as long as it holds a `DocumentCache`
+            if not isinstance( getattr( request, 'cache', None ), DocumentCache ):
+                DocumentCache( request )
+
             self._request = request
 
             request.cache.add( self )
 
             if hasattr( self, '_cache' ):
+                # Documents that are new to the request cache keep their partially loaded status
+                partial = dict( ( key, fields ) for key, fields in self._cache._partial.items() if key not in request.cache._documents )
+
                 request.cache.add( self._cache._documents.values() )
+                request.cache._partial.update( partial )
+
+                for key, expires in self._cache._missing.items():
+                    request.cache._missing.setdefault( key, expires )
                 self._cache._documents.clear()
+                self._cache._partial.clear()
+                self._cache._missing.clear()
+
+                # Hand over pending proxies, so they'll be loaded through (and batched in) the request cache
+                for key, proxy in self._cache._proxies.items():
+                    proxy._cache = request.cache
+                    request.cache._proxies.setdefault( key, proxy )
+                self._cache._proxies.clear()
 
             self._cache = request.cache
 
@@ -1013,6 +2347,37 @@ class RelationManagerMixin( object ):
                 self.update_relations()
 
 
+def get_ids( docs ):
+    '''
+    Normalise a relation value (a mixture of Documents, DBRefs and `GenericReferenceField` values) into
+    a list holding the id of each (non-empty) item, in the same order.
+
+    @rtype: list
+    '''
+    return [ get_id( doc ) for doc in docs if doc ]
+
+
+def relation_diff( first_set, second_set ):
+    '''
+    Determine the differences between two sets containing a (possible) mixture of Documents and DBRefs,
+    normalising both sets just once.
+
+    @return: a tuple of the items in `first_set` that aren't in `second_set`, and the items in `second_set`
+        that aren't in `first_set`
+    @rtype: tuple
+    '''
+    first_docs = [ doc for doc in first_set if doc ]
+    second_docs = [ doc for doc in second_set if doc ]
+    first_ids = get_ids( first_docs )
+    second_ids = get_ids( second_docs )
+
+    # The common case: nothing changed
+    if first_ids == second_ids:
+        return set(), set()
+
+    return _difference( first_docs, first_ids, second_ids ), _difference( second_docs, second_ids, first_ids )
+
+
 def set_difference( first_set, second_set ):
     '''
     Determine the difference between two sets containing a (possible) mixture of Documents and DBRefs.
@@ -1022,29 +2387,19 @@ def set_difference( first_set, second_set ):
     @param second_set:
     @return:
     '''
-    second_set_ids = set()
-    for doc_or_ref in second_set:
-        if doc_or_ref:
-            if isinstance( doc_or_ref, Document ):
-                second_set_ids.add(doc_or_ref.pk)
-            elif isinstance( doc_or_ref, DBRef ):
-                second_set_ids.add(doc_or_ref.id)
-
-    diff = set()
-    for doc_or_ref in first_set:
-        if doc_or_ref:
-            match = False
-            if isinstance(doc_or_ref, Document):
-                if doc_or_ref.pk in second_set_ids:
-                    match = True
-            elif isinstance( doc_or_ref, DBRef ):
-                if doc_or_ref.id in second_set_ids:
-                    match = True
-
-            if not match:
-                diff.add( doc_or_ref )
-
-    return diff
+    first_docs = [ doc for doc in first_set if doc ]
+    return _difference( first_docs, get_ids( first_docs ), get_ids( second_set ) )
+
+
+def _difference( docs, ids, other_ids ):
+    '''
+    Get the items in `docs` whose id (in `ids`) isn't in `other_ids`.
+    '''
+    if not other_ids:
+        return set( docs )
+
+    other_ids = set( other_ids )
+    return set( doc for doc, doc_id in zip( docs, ids ) if doc_id not in other_ids )
 
 
 def equals( doc_or_ref1, doc_or_ref2=False ):
@@ -1052,6 +2407,8 @@ def equals( doc_or_ref1, doc_or_ref2=False ):
     Determine if two Documents (or DBRefs representing documents) are equal.
     A DBRef pointing to a Document is considered to be equal to that Document.
     '''
+    if doc_or_ref1 is doc_or_ref2:
+        return True
 
     # If either one is an ObjectId or DBRef, compare ids.
     # (if the other object doesn't have a pk yet, they can't be equal).
@@ -1065,11 +2422,20 @@ def equals( doc_or_ref1, doc_or_ref2=False ):
             doc_or_ref2 = doc_or_ref2[ '_ref' ]
 
         if isinstance( doc_or_ref1, (ObjectId, DBRef) ) or isinstance( doc_or_ref2, (ObjectId, DBRef) ):
-            doc_or_ref1 = doc_or_ref1 if isinstance( doc_or_ref1, ObjectId ) else doc_or_ref1.id if isinstance( doc_or_ref1, DBRef ) else doc_or_ref1.pk
-            doc_or_ref2 = doc_or_ref2 if isinstance( doc_or_ref2, ObjectId ) else doc_or_ref2.id if isinstance( doc_or_ref2, DBRef ) else doc_or_ref2.pk
+            return get_id( doc_or_ref1 ) == get_id( doc_or_ref2 )
 
     return doc_or_ref1 == doc_or_ref2
 
 
+def get_id( doc_or_ref ):
+    '''
+    Get the id of a Document, DBRef, or `GenericReferenceField` value.
+    '''
+    if isinstance( doc_or_ref, dict ) and '_ref' in doc_or_ref:
+        doc_or_ref = doc_or_ref[ '_ref' ]
+
+    return doc_or_ref.id if isinstance( doc_or_ref, DBRef ) else doc_or_ref.pk if isinstance( doc_or_ref, Document ) else doc_or_ref
+
+
 def nequals( doc_or_ref1, doc_or_ref2=None ):
     return not equals( doc_or_ref1, doc_or_ref2 )
@@ -0,0 +1,335 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import functools
+import threading
+
+from .cache import DocumentCache, ThreadSafeDocumentCache
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+# The active scopes, innermost first, as nested `( scope, outer scopes )` tuples
+if ContextVar is not None:
+    _scopes = ContextVar( 'mongoengine_relational_scopes', default=None )
+    _get_scopes = _scopes.get
+    _set_scopes = _scopes.set
+else:
+    # Without `contextvars`, scopes are tracked per thread
+    _local = threading.local()
+
+    def _get_scopes():
+        return getattr( _local, 'scopes', None )
+
+    def _set_scopes( scopes ):
+        _local.scopes = scopes
+
+
+def get_current_scope():
+    scopes = _get_scopes()
+    return scopes[ 0 ] if scopes is not None else None
+
+
+def _activate( scope ):
+    _set_scopes( ( scope, _get_scopes() ) )
+
+
+def _deactivate( scope ):
+    '''
+    Leave the innermost activation of `scope` in the current context, along with any scopes that were
+    activated within it. Each context (thread or asyncio task) has its own stack of scopes, so entering
+    one scope from interleaved tasks is fine.
+    '''
+    scopes = _get_scopes()
+    while scopes is not None and scopes[ 0 ] is not scope:
+        scopes = scopes[ 1 ]
+
+    if scopes is not None:
+        _set_scopes( scopes[ 1 ] )
+
+
+def get_current_request():
+    '''
+    Get the request (or other unit of work) of the active `CacheScope`, if any.
+    '''
+    scope = get_current_scope()
+    return scope.request if scope is not None else None
+
+
+class CacheScope( object ):
+    '''
+    A unit of work that owns a `DocumentCache`. Use it as a context manager; while it's active, `save`, `update`
+    and `delete` on `RelationManagerMixin` documents use it when they aren't given a request:
+
+        with CacheScope():
+            zoo = Zoo( name='Artis' )
+            zoo.save()
+
+    A scope can be passed anywhere a request is expected. It's tracked using `contextvars` where available
+    (so asyncio tasks inherit it), or per thread otherwise. Use `wrap` to run a function in this scope on
+    another thread; that requires a `ThreadSafeDocumentCache`, which is what a scope creates by default.
+
+    To adapt a framework's request object, pass it as `request`; it'll be handed to `save`, `delete` and hooks
+    instead of the scope, and its `cache` is used (or created) as the scope's cache.
+
+    With `defer_hooks`, the `on_change*` callbacks for documents saved or updated in this scope are queued
+    instead of called right away. Changes to the same document are merged, so every callback fires once
+    per `flush` with the net change (for example, the documents that ended up added to a relation).
+    The scope flushes when it's left, also when that's because of an exception: the changes have been
+    written, so their callbacks fire like they would have without `defer_hooks`. Callbacks for writes that
+    fail when the scope commits are dropped along with them.
+
+    With `coalesce_writes`, saving a document that already exists only queues it; repeated saves of the
+    same document are written once when the scope commits (in a single `WriteBatch`), so hooks see the net
+    change. Queued changes aren't stored until then, though queries in the scope return its instances (see
+    `RelationalQuerySet`). New documents are saved right away, as they need an id. The scope commits when
+    it's left without an exception; queued saves are dropped otherwise.
+    '''
+    def __init__( self, request=None, cache=None, defer_hooks=False, coalesce_writes=False ):
+        self.request = request if request is not None else self
+        self.defer_hooks = defer_hooks
+        self.coalesce_writes = coalesce_writes
+
+        if cache is None:
+            cache = getattr( self.request, 'cache', None )
+            if cache is None:
+                cache = ThreadSafeDocumentCache( self.request )
+            elif not isinstance( cache, DocumentCache ):
+                raise TypeError( 'The `cache` of a {} should be a `DocumentCache`; got `{}`'.format( type( self.request ).__name__, cache ) )
+
+        self.cache = cache
+        self._change_sets = collections.OrderedDict()
+        self._saves = collections.OrderedDict()
+        self._committing = False
+
+    def __enter__( self ):
+        _activate( self )
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        failed = exc_type is not None
+
+        try:
+            if not failed:
+                self.commit()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            try:
+                if self._change_sets:
+                    self.flush()
+            except Exception:
+                # Don't mask the exception that we're exiting with
+                if not failed:
+                    raise
+            finally:
+                self._saves.clear()
+                self._change_sets.clear()
+                _deactivate( self )
+
+    def defers_save( self, doc ):
+        '''
+        Determine whether saving `doc` should be queued (see `coalesce_writes`).
+
+        @rtype: bool
+        '''
+        return self.coalesce_writes and not self._committing and bool( doc.pk ) and not doc._created
+
+    def defer_save( self, doc, kwargs ):
+        '''
+        Queue `doc` to be saved when this scope commits; `kwargs` for `save` replace those of earlier saves.
+        '''
+        self._saves.pop( id( doc ), None )
+        self._saves[ id( doc ) ] = ( doc, kwargs )
+
+    def commit( self ):
+        '''
+        Save the queued documents, writing them together in a `WriteBatch`.
+
+        @return: the number of documents saved
+        @rtype: int
+        '''
+        from .batch import WriteBatch
+
+        count = 0
+        self._committing = True
+
+        # Collect the changes of the queued saves separately, so they can be dropped if the batch fails
+        change_sets, self._change_sets = self._change_sets, collections.OrderedDict()
+
+        try:
+            with WriteBatch() as batch:
+                while self._saves:
+                    doc, kwargs = self._saves.popitem( last=False )[ 1 ]
+                    batch.save( doc, self.request, **kwargs )
+                    count += 1
+        except Exception:
+            self._change_sets = change_sets
+            raise
+        finally:
+            self._committing = False
+
+        for key, change_set in self._change_sets.items():
+            if key in change_sets:
+                change_sets[ key ].update( change_set )
+            else:
+                change_sets[ key ] = change_set
+
+        self._change_sets = change_sets
+        return count
+
+    def defer_changes( self, doc, changed_fields, changes, updated_fields ):
+        '''
+        Queue the `on_change*` callbacks for `doc`, merging `changes` with those already queued for it.
+
+        @param changed_fields: the names of the fields that have changed
+        @type changed_fields: set<string>
+        @param changes: the `( added, removed )` or `( value, previous_value )` tuple for every field
+            that has a callback, as returned by `get_changes_for_field`
+        @type changes: dict
+        @param updated_fields: the fields the change was limited to; empty if it wasn't
+        @type updated_fields: set<string>
+        '''
+        change_set = self._change_sets.get( id( doc ) )
+        if change_set is None:
+            change_set = self._change_sets[ id( doc ) ] = ChangeSet( doc, self.cache )
+
+        change_set.merge( changed_fields, changes, updated_fields )
+
+    def flush( self ):
+        '''
+        Call the queued `on_change*` callbacks. Changes made by the callbacks themselves are flushed as well.
+        '''
+        while self._change_sets:
+            change_sets, self._change_sets = self._change_sets, collections.OrderedDict()
+
+            for change_set in change_sets.values():
+                change_set.dispatch( self.request )
+
+    def wrap( self, function ):
+        '''
+        Wrap `function`, so it runs in this scope (from any thread). The scope's cache should be a
+        `ThreadSafeDocumentCache`.
+
+        @type function: callable
+        @rtype: callable
+        '''
+        if not isinstance( self.cache, ThreadSafeDocumentCache ):
+            raise TypeError( 'Running in a scope on other threads requires a `ThreadSafeDocumentCache`; got `{}`'.format( self.cache ) )
+
+        @functools.wraps( function )
+        def run_in_scope( *args, **kwargs ):
+            _activate( self )
+            try:
+                return function( *args, **kwargs )
+            finally:
+                _deactivate( self )
+
+        return run_in_scope
+
+
+class ChangeSet( object ):
+    '''
+    The net changes to the fields of a document, over any number of saves and updates.
+    '''
+    def __init__( self, doc, cache=None ):
+        '''
+        @param cache: the cache to look related documents up in (see `_get_key`)
+        @type cache: DocumentCache
+        '''
+        self.doc = doc
+        self.cache = cache
+        self.changed_fields = set()
+        self.updated_fields = None
+        self._relations = {}
+        self._values = {}
+
+    def merge( self, changed_fields, changes, updated_fields ):
+        self.changed_fields.update( changed_fields )
+
+        # An empty `updated_fields` means the change wasn't limited to specific fields
+        if self.updated_fields is None:
+            self.updated_fields = set( updated_fields )
+        elif self.updated_fields and updated_fields:
+            self.updated_fields.update( updated_fields )
+        else:
+            self.updated_fields = set()
+
+        for field_name, ( added, removed ) in changes.items():
+            if field_name in self.doc._memo_hasmany:
+                net_added, net_removed = self._relations.setdefault( field_name, ( collections.OrderedDict(), collections.OrderedDict() ) )
+
+                for doc in added:
+                    if net_removed.pop( self._get_key( doc ), None ) is None:
+                        net_added[ self._get_key( doc ) ] = doc
+
+                for doc in removed:
+                    if net_added.pop( self._get_key( doc ), None ) is None:
+                        net_removed[ self._get_key( doc ) ] = doc
+            elif field_name in self._values:
+                # Keep the first previous value, and the latest value
+                self._values[ field_name ] = ( added, self._values[ field_name ][ 1 ] )
+            else:
+                self._values[ field_name ] = ( added, removed )
+
+    def _get_key( self, doc_or_ref ):
+        '''
+        Get the key for a related document: the identity of its instance in the cache (or of the document
+        itself while it's new). A document keeps its key when it's saved, and references to it get the same
+        key; references to documents that aren't in the cache are keyed by their id.
+        '''
+        doc = self.cache.get( doc_or_ref ) if self.cache is not None else doc_or_ref
+        if doc is not None:
+            return id( doc )
+
+        return getattr( doc_or_ref, 'pk', None ) or getattr( doc_or_ref, 'id', None ) or id( doc_or_ref )
+
+    def update( self, change_set ):
+        '''
+        Merge the changes in `change_set`, made to the same document after ours, into this one.
+
+        @type change_set: ChangeSet
+        '''
+        changes = dict( ( field_name, ( list( added.values() ), list( removed.values() ) ) )
+                            for field_name, ( added, removed ) in change_set._relations.items() )
+        changes.update( change_set._values )
+
+        self.merge( change_set.changed_fields, changes, change_set.updated_fields or set() )
+
+    def dispatch( self, request ):
+        '''
+        Call the document's `on_change` and `on_change_<field>` callbacks with the net changes.
+        '''
+        doc = self.doc
+        updated_fields = self.updated_fields or set()
+
+        if hasattr( doc, 'on_change' ) and callable( doc.on_change ):
+            doc.on_change( request=request, changed_fields=self.changed_fields, updated_fields=updated_fields )
+
+        for field_name in self.changed_fields:
+            method = getattr( doc, 'on_change_{}'.format( field_name ), None )
+            if not callable( method ):
+                continue
+
+            if field_name in self._relations:
+                added, removed = self._relations[ field_name ]
+                if added or removed:
+                    method( request, set( added.values() ), set( removed.values() ), updated_fields=updated_fields )
+
+            elif field_name in self._values:
+                value, previous_value = self._values[ field_name ]
+
+                if field_name in doc._memo_hasone and value and previous_value:
+                    changed = self._get_key( value ) != self._get_key( previous_value )
+                elif field_name in doc._memo_hasone:
+                    changed = bool( value or previous_value )
+                else:
+                    changed = value != previous_value
+
+                if changed:
+                    method( request, value, previous_value, updated_fields=updated_fields )
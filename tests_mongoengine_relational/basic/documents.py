@@ -62,4 +62,51 @@ class Book( RelationManagerMixin, Document ):
 
 
 class Page( RelationManagerMixin, Document ):
-    pass
\ No newline at end of file
+    pass
+
+class Keeper( RelationManagerMixin, Document ):
+    name = StringField()
+    zoo = ReferenceField( 'Zoo', lazy=True ) # lazily dereferenced, without a related field
+
+
+class Aquarium( RelationManagerMixin, Document ):
+    name = StringField()
+    fish = ListField( ReferenceField( 'Fish' ), related_name='aquarium', storage='edges' ) # hasmany relation, stored in an edge collection
+
+
+class Fish( RelationManagerMixin, Document ):
+    name = StringField()
+    aquarium = ReferenceField( 'Aquarium', related_name='fish' ) # hasmany relation
+
+
+class Garden( RelationManagerMixin, Document ):
+    name = StringField()
+    plants = ListField( ReferenceField( 'Plant' ), related_name='garden', storage='reverse' ) # hasmany relation, derived from `Plant.garden`
+
+
+class Plant( RelationManagerMixin, Document ):
+    name = StringField()
+    garden = ReferenceField( 'Garden', related_name='plants' ) # hasmany relation
+
+
+class Habitat( RelationManagerMixin, Document ):
+    meta = { 'relational_cache': { 'scope': 'process', 'ttl': 300 } } # reference data, shared between requests
+    name = StringField()
+    updated_at = DateTimeField()
+
+
+class Visit( RelationManagerMixin, Document ):
+    meta = { 'relational_cache': { 'scope': 'none' } } # never cached
+    habitat = ReferenceField( 'Habitat' )
+
+
+class Shelter( RelationManagerMixin, Document ):
+    meta = { 'version_field': 'version', 'outbox': True } # saved with optimistic concurrency control, and recorded in the outbox
+    name = StringField()
+    version = IntField()
+    pets = ListField( ReferenceField( 'Pet' ), related_name='shelter' ) # hasmany relation
+
+
+class Pet( RelationManagerMixin, Document ):
+    name = StringField()
+    shelter = ReferenceField( 'Shelter', related_name='pets' ) # hasmany relation
@@ -1,6 +1,13 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import mongoengine
 
@@ -40,9 +47,13 @@ class CacheTestCase( unittest.TestCase ):
 
         d.cache = DocumentCache( self.request )
 
+        # Documents shared between caches outlive them; start without any
+        DocumentCache.clear_shared()
+
 
     def tearDown( self ):
         testing.tearDown()
+        DocumentCache.clear_shared()
 
         # Clear our references
         self.data = None
@@ -166,6 +177,38 @@ class CacheTestCase( unittest.TestCase ):
         self.assertTrue( d.artis._request, self.request )
         self.assertEquals( lion_doc.zoo, d.artis )
 
+    def test_lazy_reference( self ):
+        d = self.data
+
+        d.artis.save( self.request )
+        d.blijdorp.save( self.request )
+        Keeper( name='Bob', zoo=d.artis ).save( self.request )
+        Keeper( name='Alice', zoo=d.blijdorp ).save( self.request )
+
+        # Start over with an empty cache
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        alice, bob = cache.add( Keeper.objects.order_by( 'name' ) )
+
+        # A lazy reference is answered by a proxy; `pk`, equality and membership don't require a fetch
+        zoo = bob.zoo
+        self.assertIsInstance( zoo, DocumentProxy )
+        self.assertFalse( zoo.is_loaded() )
+        self.assertEqual( zoo.pk, d.artis.pk )
+        self.assertEqual( zoo, d.artis )
+        self.assertEqual( d.artis, zoo )
+        self.assertNotIn( zoo, cache )
+        self.assertIs( zoo, bob.zoo )
+
+        # Accessing a real field loads all pending proxies in one go
+        other_zoo = alice.zoo
+        self.assertEqual( zoo.name, 'Artis' )
+        self.assertTrue( other_zoo.is_loaded() )
+        self.assertIn( other_zoo, cache )
+
+        # Once loaded, the cached document itself is returned
+        self.assertIsInstance( bob.zoo, Zoo )
+        self.assertIs( bob.zoo, cache[ d.artis.pk ] )
 
 
 
@@ -175,3 +218,244 @@ class CacheTestCase( unittest.TestCase ):
 
 
 
+
+
+    def test_cached_queryset( self ):
+        d = self.data
+
+        d.dolphin.save( self.request )
+        d.mammoth.save( self.request )
+        d.tiger.save( self.request )
+
+        # Start over with a cache that only holds the dolphin
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        dolphin = cache.add( Animal.objects.get( pk=d.dolphin.pk ) )
+
+        # Lookups by id return the canonical cached instances
+        self.assertIs( Animal.objects.with_cache( request ).get( id=d.dolphin.pk ), dolphin )
+        self.assertIs( Animal.objects.with_cache( cache ).with_id( d.dolphin.pk ), dolphin )
+
+        # Missing ids are queried, and added to the cache
+        animals = list( Animal.objects.with_cache( cache ).filter( id__in=[ d.tiger.pk, d.dolphin.pk, d.mammoth.pk ] ) )
+        self.assertEqual( animals, [ d.tiger, d.dolphin, d.mammoth ] )
+        self.assertIs( animals[ 1 ], dolphin )
+        self.assertIs( animals[ 0 ], cache[ d.tiger.pk ] )
+
+        # Results of other queries are replaced by their cached duplicates as well
+        self.assertIs( Animal.objects.with_cache( cache ).get( name='Flipper' ), dolphin )
+
+        # Adding a QuerySet doesn't build new instances for documents that are already cached
+        dolphin.name = 'Flipper II'
+        animals = cache.add( Animal.objects.order_by( 'name' ) )
+        self.assertIn( dolphin, animals )
+        self.assertEqual( dolphin.name, 'Flipper II' )
+        self.assertIs( animals[ 0 ], cache[ d.mammoth.pk ] )
+
+    def test_missing_reference( self ):
+        d = self.data
+
+        d.tiger.save( self.request )
+        Zoo._get_collection().remove( { '_id': d.artis.pk } )
+
+        # Start over with an empty cache, that reports dangling references
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        missing = []
+        cache.on_missing = lambda document_type, object_id: missing.append( ( document_type, object_id ) )
+        tiger = cache.add( Animal.objects.get( pk=d.tiger.pk ) )
+
+        # The dangling reference is reported once, and isn't queried again after that
+        self.assertIsInstance( tiger.zoo, DBRef )
+        self.assertIsInstance( tiger.zoo, DBRef )
+        self.assertEqual( missing, [ ( Zoo, d.artis.pk ) ] )
+        self.assertTrue( cache.is_missing( Zoo, d.artis.pk ) )
+        self.assertEqual( cache.fetch( Zoo, [ d.artis.pk ] ), [] )
+
+        # Adding the document clears the tombstone
+        cache.add( d.artis )
+        self.assertFalse( cache.is_missing( Zoo, d.artis.pk ) )
+
+    def test_weak_cache( self ):
+        d = self.data
+
+        d.dolphin.save( self.request )
+        d.mammoth.save( self.request )
+
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request, weak=True )
+        dolphin, mammoth = cache.add( Animal.objects( pk__in=[ d.dolphin.pk, d.mammoth.pk ] ).order_by( 'name' ) )
+
+        # Documents with pending changes are kept alive; clean documents can be garbage collected
+        dolphin.name = 'Flipper II'
+        del dolphin, mammoth
+        gc.collect()
+
+        self.assertIn( d.dolphin.pk, cache )
+        self.assertNotIn( d.mammoth.pk, cache )
+
+        # Once saved, a document is only held as long as it's referenced elsewhere
+        dolphin = cache[ d.dolphin.pk ]
+        self.assertEqual( dolphin.name, 'Flipper II' )
+        dolphin.save( request )
+        self.assertIs( Animal.objects.with_cache( cache ).get( pk=d.dolphin.pk ), dolphin )
+
+        del dolphin
+        gc.collect()
+        self.assertNotIn( d.dolphin.pk, cache )
+
+        # A document that's only changed as the other side of a relation is kept alive as well
+        office = Office( id=ObjectId(), tenant=d.artis )
+        d.artis.save( self.request )
+        d.blijdorp.save( self.request )
+        office.save( self.request )
+
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request, weak=True )
+        office = cache.add( Office.objects.get( pk=office.pk ) )
+        artis = cache.add( Zoo.objects.get( pk=d.artis.pk ) )
+        self.assertEqual( artis.office, office )
+
+        office.tenant = cache.add( Zoo.objects.get( pk=d.blijdorp.pk ) )
+        self.assertIsNone( artis._data[ 'office' ] )
+        del artis
+        gc.collect()
+
+        self.assertIn( d.artis.pk, cache )
+        self.assertEqual( cache[ d.artis.pk ].get_changed_fields(), { 'office' } )
+
+    def test_cache_policies( self ):
+        savanna = Habitat( name='Savanna' )
+        savanna.save( self.request )
+        visit = Visit( habitat=savanna )
+        visit.save( self.request )
+
+        # Documents with 'none' scope aren't cached
+        self.assertNotIn( visit, self.data.cache )
+        self.assertIsNone( self.data.cache[ visit.pk ] )
+
+        # Documents with 'process' scope are shared between caches, without querying them again
+        Habitat._get_collection().remove( { '_id': savanna.pk } )
+
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        habitat = cache[ savanna.pk ]
+        self.assertEqual( habitat.name, 'Savanna' )
+        self.assertIsNot( habitat, savanna )
+        self.assertIs( cache.fetch( Habitat, [ savanna.pk ] )[ 0 ], habitat )
+
+        # Expired documents aren't dropped while they have pending changes
+        habitat.name = 'Serengeti'
+        cache._expires[ str( savanna.pk ) ] = time.time()
+        self.assertIs( cache[ savanna.pk ], habitat )
+
+        # Deleting a document stops sharing it
+        habitat.delete( request )
+        self.assertIsNone( DocumentCache()[ savanna.pk ] )
+
+    def test_invalidation_bus( self ):
+        received = []
+        bus, other_bus = MemoryBus( 'test' ), MemoryBus( 'test' )
+        other_bus.subscribe( lambda collection, object_id: received.append( ( collection, object_id ) ) )
+        DocumentCache.use_bus( bus )
+
+        try:
+            # Changes to shared documents are published; others aren't
+            savanna = Habitat( name='Savanna' )
+            savanna.save( self.request )
+            Visit( habitat=savanna ).save( self.request )
+            self.assertEqual( received, [ ( 'habitat', str( savanna.pk ) ) ] )
+
+            # Receiving an invalidation drops the shared document
+            self.assertIsNotNone( DocumentCache()[ savanna.pk ] )
+            other_bus.publish( 'habitat', str( savanna.pk ) )
+            self.assertIsNone( DocumentCache()[ savanna.pk ] )
+
+            # A state read before the invalidation isn't shared again after it
+            read_at = time.time()
+            habitat = Habitat.objects.with_cache( None ).get( pk=savanna.pk )
+            other_bus.publish( 'habitat', str( savanna.pk ) )
+            cache = DocumentCache()
+            cache.share( habitat, read_at )
+            self.assertIsNone( DocumentCache()[ savanna.pk ] )
+
+            # A state read afterwards is
+            cache.fetch( Habitat, [ savanna.pk ] )
+            self.assertIsNotNone( DocumentCache()[ savanna.pk ] )
+        finally:
+            DocumentCache.use_bus( None )
+            bus.close()
+            other_bus.close()
+
+        # Polling a bus that's listening leaves its socket blocking, so the listener doesn't spin
+        directory = tempfile.mkdtemp()
+        socket_bus = UnixSocketBus( os.path.join( directory, 'bus' ), [] )
+        try:
+            socket_bus.listen()
+            self.assertEqual( socket_bus.poll(), 0 )
+            self.assertIsNone( socket_bus._socket.gettimeout() )
+        finally:
+            socket_bus.close()
+            shutil.rmtree( directory )
+
+    def test_snapshot( self ):
+        savanna = Habitat( name='Savanna', updated_at=datetime.datetime( 2014, 1, 1 ) )
+        savanna.save( self.request )
+        jungle = Habitat( name='Jungle', updated_at=datetime.datetime( 2014, 1, 1 ) )
+        jungle.save( self.request )
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join( directory, 'snapshot' )
+        self.data.cache.dump_snapshot( path )
+
+        # Start over, as a new process would; meanwhile, `jungle` has been updated
+        DocumentCache.clear_shared()
+        Habitat.objects( pk=jungle.pk ).update( set__updated_at=datetime.datetime( 2014, 1, 2 ) )
+        Habitat.objects( pk=savanna.pk ).update( set__name='Serengeti' )
+
+        try:
+            self.assertGreaterEqual( DocumentCache.load_snapshot( path ), 2 )
+
+            # Snapshotted documents are only used when fetched (`get` doesn't query), if their version matches
+            cache = DocumentCache()
+            self.assertIsNone( cache[ savanna.pk ] )
+
+            habitats = cache.fetch( Habitat, [ savanna.pk, jungle.pk ] )
+            self.assertEqual( habitats[ 0 ].name, 'Savanna' )
+            self.assertEqual( habitats[ 1 ].name, 'Jungle' )
+            self.assertEqual( habitats[ 1 ].updated_at, datetime.datetime( 2014, 1, 2 ) )
+            self.assertIs( cache[ savanna.pk ], habitats[ 0 ] )
+        finally:
+            DocumentCache.clear_snapshot()
+            shutil.rmtree( directory )
+
+    def test_thread_safe_cache( self ):
+        cache = ThreadSafeDocumentCache()
+        ids = [ ObjectId() for i in range( 100 ) ]
+        results = []
+
+        def add_documents():
+            docs = [ Animal._from_son( { '_id': object_id, 'name': 'Dolly' } ) for object_id in ids ]
+            results.append( [ cache.add( doc ) for doc in docs ] )
+
+        threads = [ threading.Thread( target=add_documents ) for i in range( 8 ) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every thread got the same instance for each id
+        for docs in results:
+            self.assertEqual( [ id( doc ) for doc in docs ], [ id( cache[ object_id ] ) for object_id in ids ] )
+
+        # Removing a document that's been garbage collected drops its other state as well
+        cache = ThreadSafeDocumentCache( weak=True )
+        cache.add( Animal._from_son( { '_id': ids[ 0 ], 'name': 'Dolly' } ) )
+        cache._partial[ str( ids[ 0 ] ) ] = frozenset( [ 'name' ] )
+        gc.collect()
+        cache.remove( ids[ 0 ] )
+        self.assertNotIn( str( ids[ 0 ] ), cache._partial )
+
+        # There's one proxy per id
+        dbref = DBRef( 'animal', ids[ 1 ] )
+        self.assertIs( cache.proxy( dbref, Animal ), cache.proxy( dbref, Animal ) )
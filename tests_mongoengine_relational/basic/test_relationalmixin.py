@@ -1,15 +1,29 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import threading
 import unittest
 import mongoengine
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
 from bson import DBRef, ObjectId
 
 from pyramid import testing
 from pyramid.request import Request
 
-from mongoengine_relational.relationalmixin import set_difference, equals
+from mongoengine_relational.relationalmixin import set_difference, relation_diff, equals
+from mongoengine_relational.pyramid_adapter import cache_scope_tween_factory
+from mongoengine_relational.scope import ChangeSet
+from mongoengine_relational.executor import ThreadPoolExecutor
 
 from tests_mongoengine_relational.basic.documents import *
 from tests_mongoengine_relational.utils import Struct
@@ -307,6 +321,18 @@ class RelationsTestCase( unittest.TestCase ):
 
         self.assertFalse( zoo.get_changed_fields() )
 
+    def test_relation_diff( self ):
+        refs = [ DBRef( 'Animal', ObjectId() ) for i in range( 5000 ) ]
+        docs = [ Animal( id=ref.id ) for ref in refs ]
+
+        # No diff; references and Documents for the same ids, in another order
+        self.assertEqual( relation_diff( refs, list( reversed( docs ) ) ), ( set(), set() ) )
+
+        new_doc = Animal( id=ObjectId() )
+        added, removed = relation_diff( docs[ 1: ] + [ new_doc ], refs )
+        self.assertEqual( added, { new_doc } )
+        self.assertEqual( removed, { refs[ 0 ] } )
+
     def test_delete( self ):
         d = self.data
 
@@ -345,6 +371,589 @@ class RelationsTestCase( unittest.TestCase ):
         self.assertListEqual( d.artis.animals, [ d.mammoth, d.tiger ] )
         self.assertEqual( id( d.artis.animals[ 0 ] ), id( d.mammoth ) )
 
+    def test_reload_many( self ):
+        d = self.data
+
+        d.blijdorp.save( self.request )
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+        d.tiger.save( self.request )
+
+        # The mammoth is moved to Blijdorp behind our backs
+        Animal.objects( pk=d.mammoth.pk ).update_one( set__zoo=d.blijdorp )
+        Zoo.objects( pk=d.artis.pk ).update_one( pull__animals=d.mammoth )
+        Zoo.objects( pk=d.blijdorp.pk ).update_one( push__animals=d.mammoth, set__name='Diergaarde Blijdorp' )
+
+        # Unsaved documents are skipped
+        reloaded = RelationManagerMixin.reload_many( [ d.mammoth, d.tiger, d.artis, d.blijdorp, d.bear ] )
+        self.assertEqual( len( reloaded ), 4 )
+
+        self.assertEqual( d.mammoth.zoo, d.blijdorp )
+        self.assertEqual( d.artis.animals, [ d.tiger ] )
+        self.assertEqual( d.blijdorp.animals, [ d.mammoth ] )
+        self.assertEqual( d.blijdorp.name, 'Diergaarde Blijdorp' )
+
+        for doc in reloaded:
+            self.assertEqual( doc.get_changed_fields(), set() )
+
+    def test_load_relations_projection( self ):
+        d = self.data
+
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+        d.tiger.save( self.request )
+
+        # Start over with an empty cache
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        artis = cache.add( Zoo.objects.get( pk=d.artis.pk ) )
+
+        animals = artis.load_relations( related_fields={ 'animals': [ 'name' ] } )[ 'animals' ]
+        self.assertEqual( [ animal.name for animal in animals ], [ 'Manny', 'Shere Khan' ] )
+        self.assertIsNone( animals[ 0 ].species )
+        self.assertTrue( cache.is_partial( animals[ 0 ] ) )
+        self.assertFalse( cache.is_partial( animals[ 0 ], [ 'name' ] ) )
+
+        # The `related_name` is always loaded, so relations are still known on both sides
+        self.assertEqual( animals[ 0 ].zoo, artis )
+
+        # A full access upgrades the cached document in place
+        mammoth = cache.fetch( Animal, [ d.mammoth.pk ] )[ 0 ]
+        self.assertIs( mammoth, animals[ 0 ] )
+        self.assertEqual( mammoth.species, 'mammoth' )
+        self.assertFalse( cache.is_partial( mammoth ) )
+
+        # A document that's gone from the database can't be upgraded, so it stays partial
+        tiger = animals[ 1 ]
+        Animal._get_collection().remove( { '_id': tiger.pk } )
+        cache.upgrade( [ tiger ] )
+        self.assertIsNone( tiger.species )
+        self.assertTrue( cache.is_partial( tiger ) )
+
+    def test_load_relations_parallel( self ):
+        d = self.data
+
+        d.blijdorp.save( self.request )
+        d.office.save( self.request )
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+        d.tiger.save( self.request )
+
+        # Start over with an empty cache
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        blijdorp = cache.add( Zoo.objects.get( pk=d.blijdorp.pk ) )
+        artis = cache.add( Zoo.objects.get( pk=d.artis.pk ) )
+
+        result = blijdorp.load_relations( [ 'office', 'animals' ], parallel=True )
+        self.assertEqual( result[ 'office' ], d.office )
+        self.assertIn( d.office.pk, cache )
+
+        result = artis.load_relations( parallel=True )
+        self.assertEqual( result[ 'animals' ], [ d.mammoth, d.tiger ] )
+        self.assertIs( result[ 'animals' ][ 0 ], cache[ d.mammoth.pk ] )
+
+        # Only the queries run on other threads; the documents are added to the (plain) cache on this one
+        d.bear.save( self.request )
+        d.blijdorp.save( self.request )
+
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        blijdorp = cache.add( Zoo.objects.get( pk=d.blijdorp.pk ) )
+
+        threads = set()
+        add = cache.add
+        cache.add = lambda documents: threads.add( threading.current_thread() ) or add( documents )
+
+        result = blijdorp.load_relations( [ 'office', 'animals' ], parallel=True )
+        self.assertEqual( result[ 'office' ], d.office )
+        self.assertEqual( result[ 'animals' ], [ d.bear ] )
+        self.assertIs( cache[ d.bear.pk ], result[ 'animals' ][ 0 ] )
+        self.assertEqual( threads, { threading.current_thread() } )
+
+    def test_related_page( self ):
+        d = self.data
+
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+        d.tiger.save( self.request )
+
+        # Unsaved changes are paged from the current list
+        d.artis.animals.append( d.bear )
+        self.assertEqual( d.artis.related_page( 'animals', 1, 5 ), [ d.tiger, d.bear ] )
+
+        # Start over with an empty cache; only the requested window is dereferenced
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        artis = cache.add( Zoo.objects.get( pk=d.artis.pk ) )
+
+        page = artis.related_page( 'animals', 1, 1 )
+        self.assertEqual( page, [ d.tiger ] )
+        self.assertIn( d.tiger, cache )
+        self.assertNotIn( d.mammoth, cache )
+
+        self.assertEqual( artis.related_page( 'animals', 2, 10 ), [] )
+
+        # Negative offsets aren't supported, on either path
+        self.assertRaises( ValueError, artis.related_page, 'animals', -1, 1 )
+        self.assertRaises( ValueError, d.artis.related_page, 'animals', -1, 1 )
+        self.assertRaises( ValueError, artis.related_page, 'animals', 0, 0 )
+
+    def test_iter_related( self ):
+        d = self.data
+
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+        d.tiger.save( self.request )
+
+        # Start over with an empty cache
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        artis = cache.add( Zoo.objects.get( pk=d.artis.pk ) )
+
+        animals = list( artis.iter_related( 'animals', chunk_size=1 ) )
+        self.assertEqual( animals, [ d.mammoth, d.tiger ] )
+
+        # Neither the relation nor the cache got populated
+        self.assertIsInstance( artis._data[ 'animals' ][ 0 ], DBRef )
+        self.assertNotIn( d.mammoth, cache )
+
+        # Cached documents are used when present
+        tiger = cache.fetch( Animal, [ d.tiger.pk ] )[ 0 ]
+        self.assertIs( list( artis.iter_related( 'animals' ) )[ 1 ], tiger )
+
+    def test_edge_storage( self ):
+        oceanium = Aquarium( name='Oceanium' )
+        nemo = Fish( name='Nemo' )
+        dory = Fish( name='Dory' )
+
+        oceanium.save( self.request )
+        nemo.save( self.request )
+        dory.save( self.request )
+
+        oceanium.fish.extend( [ nemo, dory ] )
+        self.assertEqual( nemo.aquarium, oceanium )
+        self.assertIn( 'fish', oceanium.get_changed_fields() )
+        oceanium.save( self.request )
+
+        # References are stored in the edge collection, not in the document itself
+        self.assertNotIn( 'fish', Aquarium._get_collection().find_one( { '_id': oceanium.pk } ) )
+        self.assertEqual( Aquarium.fish.get_edge_collection().find( { 'src': oceanium.pk } ).count(), 2 )
+
+        # Start over with an empty cache; edges are loaded on first access
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        aquarium = cache.add( Aquarium.objects.get( pk=oceanium.pk ) )
+
+        self.assertEqual( aquarium.related_page( 'fish', 1, 1 ), [ dory ] )
+        self.assertEqual( aquarium.fish, [ nemo, dory ] )
+        self.assertFalse( aquarium.get_changed_fields() )
+
+        aquarium.fish.remove( aquarium.fish[ 0 ] )
+        added_docs, removed_docs = aquarium.get_changes_for_field( 'fish' )
+        self.assertFalse( added_docs )
+        self.assertEqual( removed_docs, { nemo } )
+
+        aquarium.save( request )
+        self.assertEqual( [ edge[ 'dst' ] for edge in Aquarium.fish.get_edge_collection().find( { 'src': oceanium.pk } ) ], [ dory.pk ] )
+
+        # Deleting a document removes its edges
+        cache[ dory.pk ].delete( request )
+        self.assertEqual( Aquarium.fish.get_edge_collection().find( { 'src': oceanium.pk } ).count(), 0 )
+
+        # An edge can only point at a saved document
+        aquarium.fish.append( Fish( name='Bruce' ) )
+        self.assertRaises( RelationalError, aquarium.save, request )
+        self.assertEqual( Aquarium.fish.get_edge_collection().find( { 'src': oceanium.pk } ).count(), 0 )
+
+    def test_reverse_storage( self ):
+        kew = Garden( name='Kew' )
+        kew.save( self.request )
+
+        rose = Plant( name='Rose', garden=kew )
+        tulip = Plant( name='Tulip', garden=kew )
+        rose.save( self.request )
+        tulip.save( self.request )
+
+        # The relation is derived from `Plant.garden`; nothing is stored on the garden
+        self.assertEqual( kew.plants, [ rose, tulip ] )
+        self.assertNotIn( 'plants', Garden._get_collection().find_one( { '_id': kew.pk } ) )
+
+        # Start over with an empty cache
+        request = Request.blank( '/api/v1/' )
+        cache = DocumentCache( request )
+        garden = cache.add( Garden.objects.get( pk=kew.pk ) )
+
+        self.assertEqual( garden.related_page( 'plants', 1, 1 ), [ tulip ] )
+        self.assertEqual( garden.plants, [ rose, tulip ] )
+
+        # Changing the relation only requires saving the plant
+        plant = garden.plants[ 0 ]
+        plant.garden = None
+        self.assertNotIn( plant, garden.plants )
+        self.assertEqual( plant.get_related_documents_to_update(), ( set(), set() ) )
+
+        plant.save( request )
+        self.assertEqual( Garden.objects.get( pk=kew.pk ).plants, [ tulip ] )
+
+        # The relation itself is read-only
+        self.assertRaises( RelationalError, garden.plants.append, plant )
+        self.assertRaises( RelationalError, setattr, garden, 'plants', [] )
+        self.assertEqual( garden.plants, [ tulip ] )
+
+    def test_relation_indexes( self ):
+        self.assertEqual( Animal.list_relation_indexes(), [ [ ( 'zoo', 1 ) ] ] )
+        self.assertItemsEqual( Zoo.list_relation_indexes(), [ [ ( 'animals', 1 ) ], [ ( 'office', 1 ) ] ] )
+        self.assertEqual( Office.list_relation_indexes(), [ [ ( 'tenant._ref.$id', 1 ) ] ] )
+
+        # Relations that aren't stored in the document don't need an index there
+        self.assertEqual( Garden.list_relation_indexes(), [] )
+
+        for document_type in ( Animal, Zoo, Office ):
+            document_type.ensure_relation_indexes()
+            self.assertEqual( document_type.compare_relation_indexes(), { 'missing': [] } )
+
+        # Edge collections are indexed on both ends
+        Aquarium.ensure_relation_indexes()
+        indexes = [ info[ 'key' ] for info in Aquarium.fish.get_edge_collection().index_information().values() ]
+        self.assertIn( [ ( 'src', 1 ), ( 'dst', 1 ) ], indexes )
+        self.assertIn( [ ( 'dst', 1 ) ], indexes )
+
+    def test_cache_scope( self ):
+        # Documents can be saved without a request inside a `CacheScope`
+        with CacheScope() as scope:
+            self.assertIs( get_current_scope(), scope )
+
+            zoo = Zoo( name='Burgers' )
+            zoo.save()
+            lion = Animal( name='Leo', zoo=zoo )
+            lion.save()
+
+            self.assertIs( scope.cache[ zoo.pk ], zoo )
+            self.assertIs( scope.cache[ lion.pk ], lion )
+            self.assertIn( lion, zoo.animals )
+
+        self.assertIsNone( get_current_scope() )
+        self.assertRaises( ValueError, Animal( name='Simba' ).save )
+
+        # A Pyramid request is adapted by a tween, which makes it the unit of work
+        request = Request.blank( '/api/v1/' )
+        tween = cache_scope_tween_factory( lambda request: get_current_scope(), None )
+        scope = tween( request )
+        self.assertIs( scope.request, request )
+        self.assertIs( scope.cache, request.cache )
+
+        # A scope creates a cache that can be used from other threads, which `wrap` requires
+        self.assertIsInstance( scope.cache, ThreadSafeDocumentCache )
+        self.assertIs( scope.wrap( get_current_scope )(), scope )
+        self.assertRaises( TypeError, CacheScope( self.request ).wrap, get_current_scope )
+
+        # A request's `cache` should be a `DocumentCache`
+        request = Request.blank( '/api/v1/' )
+        request.cache = {}
+        self.assertRaises( TypeError, CacheScope, request )
+
+    @unittest.skipIf( contextvars is None, '`contextvars` is not available' )
+    def test_cache_scope_contexts( self ):
+        scope = CacheScope()
+
+        # Contexts (like asyncio tasks) entering and leaving the same scope in turns each keep track of it
+        first, second = contextvars.copy_context(), contextvars.copy_context()
+        first.run( scope.__enter__ )
+        second.run( scope.__enter__ )
+        first.run( scope.__exit__, None, None, None )
+
+        self.assertIsNone( first.run( get_current_scope ) )
+        self.assertIs( second.run( get_current_scope ), scope )
+        second.run( scope.__exit__, None, None, None )
+        self.assertIsNone( second.run( get_current_scope ) )
+        self.assertIsNone( get_current_scope() )
+
+    def test_scope_identity_map( self ):
+        d = self.data
+
+        d.artis.save( self.request )
+
+        with CacheScope() as scope:
+            artis = Zoo.objects.get( pk=d.artis.pk )
+            self.assertIs( scope.cache[ artis.pk ], artis )
+
+            # Queries return the scope's instances, with their unsaved changes
+            artis.name = 'Artis Royal Zoo'
+            self.assertIs( Zoo.objects.get( name='Artis' ), artis )
+            self.assertEqual( Zoo.objects.get( pk=d.artis.pk ).name, 'Artis Royal Zoo' )
+
+            # Unless they opt out of the identity map
+            stored = Zoo.objects.with_cache( None ).get( pk=d.artis.pk )
+            self.assertIsNot( stored, artis )
+            self.assertEqual( stored.name, 'Artis' )
+
+        # Outside of a scope, queries don't use a cache
+        self.assertIsNot( Zoo.objects.get( pk=d.artis.pk ), artis )
+
+    def test_deferred_hooks( self ):
+        d = self.data
+
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+        d.tiger.save( self.request )
+
+        changes = []
+        d.artis.on_change_animals = lambda request, added, removed, **kwargs: changes.append( ( added, removed ) )
+
+        # Callbacks fire once, with the net changes, when the scope is flushed
+        with CacheScope( self.request, defer_hooks=True ):
+            lion = Animal( id=ObjectId(), name='Simba', species='lion' )
+            d.artis.animals.remove( d.mammoth )
+            d.artis.save()
+            d.artis.animals.extend( [ d.mammoth, lion ] )
+            d.artis.save()
+            self.assertEqual( changes, [] )
+
+        self.assertEqual( changes, [ ( { lion }, set() ) ] )
+
+        # Changes that have been saved are flushed when the scope is left with an exception too
+        del changes[:]
+
+        with self.assertRaises( KeyError ):
+            with CacheScope( self.request, defer_hooks=True ):
+                d.artis.animals.remove( lion )
+                d.artis.save()
+                raise KeyError( 'lion' )
+
+        self.assertEqual( changes, [ ( set(), { lion } ) ] )
+
+        # A callback that fails while the scope is left with an exception doesn't mask that exception
+        def fail( request, added, removed, **kwargs ):
+            raise ValueError()
+
+        d.artis.on_change_animals = fail
+
+        with self.assertRaises( KeyError ):
+            with CacheScope( self.request, defer_hooks=True ):
+                d.artis.animals.append( lion )
+                d.artis.save()
+                raise KeyError( 'lion' )
+
+        # A new document that's added, saved, and removed again cancels out
+        d.artis.on_change_animals = lambda request, added, removed, **kwargs: changes.append( ( added, removed ) )
+        del changes[:]
+
+        kitten = Animal( name='Kitty', species='cat' )
+        change_set = ChangeSet( d.artis, self.request.cache )
+        change_set.merge( { 'animals' }, { 'animals': ( [ kitten ], [] ) }, set() )
+        kitten.save( self.request )
+        change_set.merge( { 'animals' }, { 'animals': ( [], [ DBRef( Animal._get_collection_name(), kitten.pk ) ] ) }, set() )
+        change_set.dispatch( self.request )
+        self.assertEqual( changes, [] )
+
+    def test_coalesce_writes( self ):
+        d = self.data
+
+        d.blijdorp.save( self.request )
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+
+        names = []
+        d.artis.on_change_name = lambda request, value, previous_value, **kwargs: names.append( ( value, previous_value ) )
+
+        # Repeated saves are written once, when the scope commits
+        with CacheScope( self.request, coalesce_writes=True ):
+            d.artis.name = 'Artis Royal Zoo'
+            d.artis.save()
+
+            # Saving the mammoth doesn't drop the changes it makes to both zoos
+            d.mammoth.zoo = d.blijdorp
+            d.mammoth.save()
+            d.blijdorp.save()
+
+            d.artis.name = 'Natura Artis Magistra'
+            d.artis.save()
+            self.assertEqual( Zoo._get_collection().find_one( { '_id': d.artis.pk } )[ 'name' ], 'Artis' )
+
+            # A queued save is validated right away; it doesn't fail the other saves when the scope commits
+            species = d.mammoth.species
+            d.mammoth.species = None
+            self.assertRaises( ValidationError, d.mammoth.save )
+            d.mammoth.species = species
+
+        self.assertEqual( names, [ ( 'Natura Artis Magistra', 'Artis' ) ] )
+        self.assertEqual( Zoo.objects.get( pk=d.artis.pk ).name, 'Natura Artis Magistra' )
+        self.assertNotIn( d.mammoth, Zoo.objects.get( pk=d.artis.pk ).animals )
+        self.assertIn( d.mammoth, Zoo.objects.get( pk=d.blijdorp.pk ).animals )
+
+    @unittest.skipIf( ThreadPoolExecutor is None, '`concurrent.futures` is not available' )
+    def test_async_api( self ):
+        d = self.data
+
+        # Asynchronous operations need a cache that's safe to use from other threads
+        d.artis.save( self.request )
+        self.assertRaises( RelationalError, d.mammoth.asave, self.request )
+        self.assertRaises( RelationalError, d.artis.aload, 'animals' )
+
+        request = Request.blank( '/api/v1/' )
+        ThreadSafeDocumentCache( request )
+        d.mammoth.save( self.request )
+
+        lion = Animal( name='Leo' )
+        lion.asave( request ).result()
+        self.assertIsNotNone( Animal.objects.get( pk=lion.pk ) )
+
+        # Start over with an empty cache
+        request = Request.blank( '/api/v1/' )
+        cache = ThreadSafeDocumentCache( request )
+        artis = cache.add( Zoo.objects.get( pk=d.artis.pk ) )
+
+        result = artis.aload( 'animals' ).result()
+        self.assertEqual( result[ 'animals' ], [ d.mammoth ] )
+        self.assertIn( d.mammoth.pk, cache )
+
+        cache.fetch( Animal, [ lion.pk ] )[ 0 ].adelete( request ).result()
+        self.assertEqual( Animal.objects( pk=lion.pk ).count(), 0 )
+
+    @unittest.skipIf( ThreadPoolExecutor is None or asyncio is None, '`concurrent.futures` or `asyncio` is not available' )
+    def test_async_await( self ):
+        d = self.data
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+
+        request = Request.blank( '/api/v1/' )
+        cache = ThreadSafeDocumentCache( request )
+        artis = cache.add( Zoo.objects.get( pk=d.artis.pk ) )
+
+        # The futures can be awaited by asyncio code
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete( artis.aload( 'animals' ) )
+        finally:
+            loop.close()
+
+        self.assertEqual( result[ 'animals' ], [ d.mammoth ] )
+
+    def test_version_conflict( self ):
+        shelter = Shelter( name='Dierenasiel' )
+        shelter.save( self.request )
+        self.assertEqual( shelter.version, 1 )
+
+        rex = Pet( name='Rex', shelter=shelter )
+        rex.save( self.request )
+        shelter.save( self.request )
+        self.assertEqual( shelter.version, 2 )
+
+        # Two requests load the shelter, and both add a pet
+        first_request = Request.blank( '/api/v1/' )
+        DocumentCache( first_request )
+        first = first_request.cache.add( Shelter.objects.get( pk=shelter.pk ) )
+
+        second_request = Request.blank( '/api/v1/' )
+        DocumentCache( second_request )
+        second = second_request.cache.add( Shelter.objects.get( pk=shelter.pk ) )
+
+        felix = Pet( name='Felix', shelter=first )
+        felix.save( first_request )
+        first.name = 'Dierenasiel Amsterdam'
+        first.save( first_request )
+        self.assertEqual( first.version, 3 )
+
+        # `second` is outdated; its change is re-applied to the stored relation instead of overwriting it,
+        # and it takes over the stored values of fields it didn't change
+        tom = Pet( name='Tom', shelter=second )
+        tom.save( second_request )
+        second.save( second_request )
+        self.assertEqual( second.version, 4 )
+        self.assertEqual( [ pet.pk for pet in second.pets ], [ rex.pk, felix.pk, tom.pk ] )
+        self.assertEqual( [ pet.pk for pet in Shelter.objects.get( pk=shelter.pk ).pets ], [ rex.pk, felix.pk, tom.pk ] )
+        self.assertEqual( second.name, 'Dierenasiel Amsterdam' )
+        self.assertEqual( second.get_changed_fields(), set() )
+
+        # Writes to a document that has been changed by others fail after a number of retries
+        second.on_version_conflict = lambda request, son, changes: False
+        Shelter.objects( pk=shelter.pk ).update_one( set__version=5 )
+        second.name = 'Asiel'
+        self.assertRaises( VersionConflictError, second.save, second_request )
+
+    def test_change_feed( self ):
+        shelter = Shelter( name='Dierenasiel' )
+        shelter.save( self.request )
+
+        rex = Pet( name='Rex', shelter=shelter )
+        rex.save( self.request )
+        shelter.save( self.request )
+
+        feed = ChangeFeed( settle=None )
+        records = list( feed )
+        self.assertEqual( [ ( record[ 'field' ], record[ 'added' ], record[ 'version' ] ) for record in records ], [ ( 'pets', [ rex.pk ], 2 ) ] )
+
+        # A new feed resumes after the last record that was seen
+        tom = Pet( name='Tom', shelter=shelter )
+        tom.save( self.request )
+        rex.delete( self.request )
+        shelter.save( self.request )
+
+        feed = ChangeFeed( resume_token=feed.resume_token, settle=None )
+        self.assertEqual( [ ( record[ 'added' ], record[ 'removed' ] ) for record in feed ], [ ( [ tom.pk ], [ rex.pk ] ) ] )
+
+        # Records get their id when their batch executes, so a feed that has read on in the meantime doesn't skip them
+        felix = Pet( name='Felix', shelter=shelter )
+        felix.save( self.request )
+        batch = WriteBatch()
+        batch.save( shelter, self.request )
+
+        resume_token = str( ObjectId() )
+        batch.execute()
+
+        feed = ChangeFeed( resume_token=resume_token, settle=None )
+        self.assertEqual( [ record[ 'added' ] for record in feed ], [ [ felix.pk ] ] )
+
+    def test_save_with_related( self ):
+        d = self.data
+
+        d.blijdorp.save( self.request )
+        d.artis.save( self.request )
+        d.mammoth.save( self.request )
+
+        # Moving the mammoth changes both zoos; they're written in one batch
+        d.mammoth.zoo = d.blijdorp
+        saved, deleted = d.mammoth.save_with_related( self.request )
+        self.assertIn( d.blijdorp, saved )
+        self.assertEqual( deleted, set() )
+
+        self.assertEqual( Animal.objects.get( pk=d.mammoth.pk ).zoo, d.blijdorp )
+        self.assertIn( d.mammoth, Zoo.objects.get( pk=d.blijdorp.pk ).animals )
+        self.assertNotIn( d.mammoth, Zoo.objects.get( pk=d.artis.pk ).animals )
+
+        # Updates aren't checked against the database when they're recorded; one that doesn't match is ignored
+        batch = WriteBatch()
+        d.tiger.save( self.request )
+        Animal.objects( pk=d.tiger.pk ).delete()
+        d.tiger.name = 'Tigger'
+        self.assertEqual( batch.update( d.tiger, self.request, 'name' ), 1 )
+        self.assertEqual( len( batch ), 1 )
+        batch.execute()
+        self.assertIsNone( Animal.objects( pk=d.tiger.pk ).first() )
+
+        # A versioned write that's overtaken before the batch executes is retried then, with the stored document merged
+        shelter = Shelter( name='Dierenasiel' )
+        shelter.save( self.request )
+        shelter.name = 'Asiel'
+        batch.save( shelter, self.request )
+        self.assertEqual( shelter.get_changed_fields(), set() )
+
+        Shelter.objects( pk=shelter.pk ).update_one( set__version=5 )
+        batch.execute()
+        self.assertEqual( shelter.version, 6 )
+        self.assertEqual( shelter.get_changed_fields(), set() )
+        stored = Shelter._get_collection().find_one( { '_id': shelter.pk } )
+        self.assertEqual( ( stored[ 'name' ], stored[ 'version' ] ), ( 'Asiel', 6 ) )
+
+        # When it can't be retried, executing fails; the document keeps its changes
+        shelter.name = 'Dierenopvang'
+        batch.save( shelter, self.request )
+        Shelter.objects( pk=shelter.pk ).delete()
+        self.assertRaises( VersionConflictError, batch.execute )
+        self.assertEqual( shelter.version, 6 )
+        self.assertIn( 'name', shelter.get_changed_fields() )
+
     def test_memoize_documents( self ):
         pass
 
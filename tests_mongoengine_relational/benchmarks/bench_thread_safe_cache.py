@@ -0,0 +1,60 @@
+'''
+Compare `DocumentCache` and `ThreadSafeDocumentCache` under many threads. Each thread adds its own instances
+of the same ids, and then looks every id up again. No database is needed.
+
+    python -m tests_mongoengine_relational.benchmarks.bench_thread_safe_cache [threads] [ids]
+
+Reports the wall time per cache, and the number of ids for which the threads didn't all get the same instance
+(which should be 0 for the `ThreadSafeDocumentCache`).
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import threading
+import time
+
+from bson import ObjectId
+
+from mongoengine_relational import DocumentCache, ThreadSafeDocumentCache
+
+from tests_mongoengine_relational.basic.documents import Animal
+
+
+def run( cache, thread_count, ids ):
+    '''
+    @return: the wall time, and the number of ids that resolved to more than one instance
+    @rtype: tuple
+    '''
+    barrier = threading.Event()
+    results = []
+
+    def work():
+        docs = [ Animal._from_son( { '_id': object_id, 'name': 'Dolly' } ) for object_id in ids ]
+        barrier.wait()
+        added = [ cache.add( doc ) for doc in docs ]
+        results.append( [ id( cache[ doc.pk ] ) for doc in added ] )
+
+    threads = [ threading.Thread( target=work ) for i in range( thread_count ) ]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    duplicates = sum( 1 for instances in zip( *results ) if len( set( instances ) ) > 1 )
+    return elapsed, duplicates
+
+
+if __name__ == '__main__':
+    thread_count = int( sys.argv[ 1 ] ) if len( sys.argv ) > 1 else 16
+    id_count = int( sys.argv[ 2 ] ) if len( sys.argv ) > 2 else 2000
+    ids = [ ObjectId() for i in range( id_count ) ]
+
+    for cache_class in ( DocumentCache, ThreadSafeDocumentCache ):
+        elapsed, duplicates = run( cache_class(), thread_count, ids )
+        print( '{:<24} {} threads x {} ids: {:.3f}s, {} ids with duplicate instances'.format(
+            cache_class.__name__, thread_count, id_count, elapsed, duplicates ) )